@@ -0,0 +1,515 @@
+#!/usr/bin/env python3
+
+# Offline load test for the handlers in run.py.
+#
+# run.py is loaded as a module with a throwaway data directory, and its client is replaced with a fake one. Every
+# request that would go to Discord goes to a local HTTP sink instead, so this needs no token and no network.
+#
+# Usage: python3 bench.py [scenario ...] [--users N] [--messages N] [--latency SECONDS] ...
+# Scenarios: dm_storm, typing_flood, staff_replies, forward_file, faults, gen_color, profiles, ignore_db,
+#            ignore_bulk (default: all of them)
+
+import argparse
+import asyncio
+import importlib.util
+import itertools
+import os
+import random
+import tempfile
+import tracemalloc
+from datetime import datetime, timezone
+from os.path import abspath, dirname, join
+from time import perf_counter
+from typing import TYPE_CHECKING
+
+import aiohttp
+import disnake
+from aiohttp import web
+
+if TYPE_CHECKING:
+    from typing import Awaitable, Callable, Dict, List, Optional
+
+repo_dir = dirname(abspath(__file__))
+
+bench_config = """
+[Main]
+token = offline
+channel_id = 1
+command_prefix = ?
+anonymous_staff = true
+playing = benchmarking
+post_startup_message = false
+
+[AntiSpam]
+; high enough that storms measure relaying and not auto-ignoring
+seconds = 1
+messages = 1000000
+"""
+
+
+def load_modmail(data_dir: str, channels: int = 1):
+    with open(join(data_dir, 'config.ini'), 'w', encoding='utf-8') as f:
+        f.write(bench_config)
+        # channel_id is 1, the rest are numbered after it
+        f.write(f'\n[Routing]\nchannels = {" ".join(str(x) for x in range(2, channels + 1))}\n')
+    os.environ['MODMAIL_DATA_DIR'] = data_dir
+    spec = importlib.util.spec_from_file_location('modmail', join(repo_dir, 'run.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Sink:
+    """Local HTTP server standing in for Discord: records sends and serves attachment data."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.requests = 0
+        self.downloads = 0
+        # how many of the next sends fail, alternating between 503 and 429 like an outage would
+        self.failures = 0
+        self.session = None  # type: Optional[aiohttp.ClientSession]
+        self.url = ''
+        self._runner = None  # type: Optional[web.AppRunner]
+
+    async def start(self):
+        app = web.Application(client_max_size=0x4000000)
+        app.router.add_post('/send', self.handle_send)
+        app.router.add_get('/attachments/{size}/{name}', self.handle_attachment)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://127.0.0.1:{port}'
+        self.session = aiohttp.ClientSession()
+
+    async def stop(self):
+        await self.session.close()
+        await self._runner.cleanup()
+
+    async def handle_send(self, request: web.Request) -> web.Response:
+        # drained instead of read() so the sink doesn't keep request bodies around and skew the memory numbers
+        async for _ in request.content.iter_any():
+            pass
+        await asyncio.sleep(self.latency)
+        if self.failures:
+            self.failures -= 1
+            status = 503 if self.failures % 2 else 429
+            return web.json_response({'message': 'injected failure', 'code': 0, 'retry_after': 0}, status=status)
+        self.requests += 1
+        return web.json_response({'id': self.requests})
+
+    async def handle_attachment(self, request: web.Request) -> web.Response:
+        self.downloads += 1
+        await asyncio.sleep(self.latency)
+        return web.Response(body=bytes(int(request.match_info['size'])))
+
+    async def send(self, payload: dict, files: 'List[disnake.File]' = ()) -> int:
+        data = aiohttp.FormData()
+        data.add_field('payload_json', disnake.utils._to_json(payload))
+        for idx, f in enumerate(files):
+            data.add_field(f'files[{idx}]', f.fp.read(), filename=f.filename)
+        async with self.session.post(self.url + '/send', data=data) as resp:
+            if resp.status >= 400:
+                raise disnake.HTTPException(resp, await resp.json())
+            return (await resp.json())['id']
+
+
+class FakeAsset:
+    def __init__(self, url: str):
+        self.url = url
+
+
+class FakeAttachment:
+    # unique for the whole run, the spool in run.py remembers attachments by ID
+    ids = itertools.count(1)
+
+    def __init__(self, sink: Sink, filename: str, size: int):
+        self.sink = sink
+        self.id = next(self.ids)
+        self.filename = filename
+        self.size = size
+        self.url = f'{sink.url}/attachments/{size}/{filename}'
+
+    async def read(self) -> bytes:
+        async with self.sink.session.get(self.url) as resp:
+            return await resp.read()
+
+
+class FakeMessage:
+    def __init__(self, sink: Sink, author, channel, content: str = '', attachments: 'List[FakeAttachment]' = ()):
+        self.sink = sink
+        self.id = 0
+        self.author = author
+        self.channel = channel
+        self.content = content
+        self.attachments = list(attachments)
+        self.created_at = datetime.now(timezone.utc)
+
+    async def add_reaction(self, emoji: str):
+        await self.sink.send({'emoji': emoji})
+
+    async def edit(self, content: str = None, **kwargs):
+        await self.sink.send({'content': content})
+
+    async def delete(self):
+        await self.sink.send({'delete': self.id})
+
+
+class Messageable:
+    sink = None  # type: Sink
+
+    async def send(self, content: str = None, *, embed: disnake.Embed = None, embeds: 'List[disnake.Embed]' = None,
+                   files: 'List[disnake.File]' = (), **kwargs) -> FakeMessage:
+        if embed:
+            embeds = [embed]
+        payload = {'content': content, 'embeds': [e.to_dict() for e in embeds or ()]}
+        msg = FakeMessage(self.sink, None, self, content or '',
+                          [FakeAttachment(self.sink, f.filename, 0) for f in files])
+        msg.id = await self.sink.send(payload, files)
+        return msg
+
+
+class FakeTextChannel(Messageable):
+    def __init__(self, sink: Sink, channel_id: int):
+        self.sink = sink
+        self.id = channel_id
+        self.typing_triggers = 0
+        # staff messages that outbox retries can fetch again
+        self.messages = {}  # type: Dict[int, FakeMessage]
+
+    async def trigger_typing(self):
+        self.typing_triggers += 1
+        await self.sink.send({'typing': True})
+
+    async def fetch_message(self, message_id: int) -> 'FakeMessage':
+        return self.messages[message_id]
+
+    def get_partial_message(self, message_id: int) -> 'FakeMessage':
+        message = FakeMessage(self.sink, None, self)
+        message.id = message_id
+        return message
+
+
+class FakeDMChannel(disnake.DMChannel):
+    # disnake.DMChannel is only subclassed so the isinstance checks in run.py see a DM
+    def __init__(self, recipient):
+        self.recipient = recipient
+        self.id = recipient.id
+
+
+class FakeMember(Messageable, disnake.Member):
+    # plain class attributes shadow the properties and slots of disnake.Member
+    id = 0
+    nick = None
+    name = ''
+    avatar = None
+    default_avatar = None
+    mention = ''
+
+    def __init__(self, sink: Sink, user_id: int, nick: 'Optional[str]' = None):
+        self.sink = sink
+        self.id = user_id
+        self.nick = nick
+        self.name = f'user{user_id}'
+        self.default_avatar = FakeAsset(f'https://cdn.invalid/embed/avatars/{user_id % 5}.png')
+        self.mention = f'<@{user_id}>'
+
+    def __str__(self) -> str:
+        return self.name
+
+    __hash__ = object.__hash__
+
+
+class FakeClient:
+    """Has just the parts of disnake.Client that run.py uses."""
+
+    def __init__(self, sink: Sink, channels: int):
+        self.sink = sink
+        self.channels = {x: FakeTextChannel(sink, x) for x in range(1, channels + 1)}
+        self.channel = self.channels[1]
+        self.modmail_channels = {}
+        self.user = FakeMember(sink, 1)
+        self.guilds = []
+        self.users = {}
+        self.already_ready = True
+
+    def get_user(self, user_id: int) -> 'Optional[FakeMember]':
+        return self.users.get(user_id)
+
+    async def fetch_user(self, user_id: int) -> FakeMember:
+        return self.users[user_id]
+
+    def get_channel(self, channel_id: int) -> 'Optional[FakeTextChannel]':
+        return self.channels.get(channel_id)
+
+    def get_partial_messageable(self, channel_id: int, type: 'Optional[disnake.ChannelType]' = None) -> FakeTextChannel:
+        # outbox retries of relays react to the DM through one of these
+        return FakeTextChannel(self.sink, channel_id)
+
+    def get_guild(self, guild_id: int):
+        return None
+
+    async def change_presence(self, **kwargs):
+        pass
+
+
+class Result:
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies = []  # type: List[float]
+        self.elapsed = 0.0
+        self.peak_memory = 0
+        self.notes = []  # type: List[str]
+
+    def report(self):
+        count = len(self.latencies)
+        print(f'== {self.name}')
+        if count:
+            latencies = sorted(self.latencies)
+            p50 = latencies[int(0.50 * (count - 1))]
+            p99 = latencies[int(0.99 * (count - 1))]
+            print(f'   {count} operations in {self.elapsed:.3f}s, {count / self.elapsed:.1f} ops/s')
+            print(f'   latency p50 {p50 * 1000:.2f}ms, p99 {p99 * 1000:.2f}ms, max {latencies[-1] * 1000:.2f}ms')
+        print(f'   peak memory above baseline {self.peak_memory / (1024 * 1024):.2f} MiB')
+        for note in self.notes:
+            print(f'   {note}')
+
+
+async def measure(result: Result, calls: 'List[Callable[[], Awaitable[None]]]', concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed(call):
+        async with semaphore:
+            start = perf_counter()
+            await call()
+            result.latencies.append(perf_counter() - start)
+
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    start = perf_counter()
+    await asyncio.gather(*(timed(c) for c in calls))
+    result.elapsed = perf_counter() - start
+    result.peak_memory = tracemalloc.get_traced_memory()[1] - baseline
+
+
+def make_users(modmail, sink: Sink, count: int, first_id: int = 1000) -> 'List[FakeMember]':
+    users = [FakeMember(sink, first_id + i, nick=f'nick{i}' if i % 2 else None) for i in range(count)]
+    modmail.client.users.update((u.id, u) for u in users)
+    return users
+
+
+async def bench_dm_storm(modmail, sink: Sink, args) -> Result:
+    result = Result(f'dm_storm: {args.users} users x {args.messages} messages')
+    users = make_users(modmail, sink, args.users)
+    calls = []
+    for n in range(args.messages):
+        for user in users:
+            message = FakeMessage(sink, user, FakeDMChannel(user), f'message {n} from {user.id}')
+            calls.append(lambda m=message: modmail.on_message(m))
+    sent_before = sink.requests
+    await measure(result, calls, args.concurrency)
+    # wait for the low priority reactions too, so the next scenario starts clean
+    while any(c.relays._reactions for c in modmail.client.modmail_channels.values()):
+        await asyncio.sleep(0.01)
+    result.notes.append(f'{sink.requests - sent_before} requests sent to the sink')
+    return result
+
+
+async def bench_typing_flood(modmail, sink: Sink, args) -> Result:
+    result = Result(f'typing_flood: {args.users} users x {args.messages} events')
+    users = make_users(modmail, sink, args.users)
+    for modmail_channel in modmail.client.modmail_channels.values():
+        modmail_channel.typing_until = 0.0
+    triggers_before = sum(c.typing_triggers for c in modmail.client.channels.values())
+    calls = []
+    for _ in range(args.messages):
+        for user in users:
+            calls.append(lambda u=user: modmail.on_typing(FakeDMChannel(u), u, None))
+    await measure(result, calls, args.concurrency)
+    triggers = sum(c.typing_triggers for c in modmail.client.channels.values()) - triggers_before
+    result.notes.append(f'{triggers} typing triggers sent')
+    return result
+
+
+async def bench_staff_replies(modmail, sink: Sink, args) -> Result:
+    result = Result(f'staff_replies: {args.replies} replies x {args.attachments} attachments '
+                    f'of {args.attachment_size} bytes')
+    # every reply goes to a different user, so the per-recipient lock doesn't reject any
+    users = make_users(modmail, sink, args.replies)
+    staff = FakeMember(sink, 2, nick='staff')
+    calls = []
+    for user in users:
+        attachments = [FakeAttachment(sink, f'file{i}.bin', args.attachment_size) for i in range(args.attachments)]
+        message = FakeMessage(sink, staff, modmail.client.channel, f'?{user.id} hello', attachments)
+        calls.append(lambda m=message: modmail.on_message(m))
+    await measure(result, calls, args.concurrency)
+    return result
+
+
+async def bench_forward_file(modmail, sink: Sink, args) -> Result:
+    result = Result(f'forward_file: {args.attachments} attachments of {args.attachment_size} bytes '
+                    f'to {args.replies} users with one ?<userid>,<userid>,... reply')
+    # other users than staff_replies, whose replies would still be locked for a couple of seconds
+    users = make_users(modmail, sink, args.replies, first_id=1000000)
+    staff = FakeMember(sink, 2, nick='staff')
+    attachments = [FakeAttachment(sink, f'rules{i}.pdf', args.attachment_size) for i in range(args.attachments)]
+    user_ids = ','.join(str(user.id) for user in users)
+    message = FakeMessage(sink, staff, modmail.client.channel, f'?{user_ids} please read this', attachments)
+    downloads_before = sink.downloads
+    requests_before = sink.requests
+    await measure(result, [lambda: modmail.on_message(message)], 1)
+    # the spool is what keeps this at one download per attachment instead of one per user
+    result.notes.append(f'{sink.downloads - downloads_before} attachment downloads, '
+                        f'{sink.requests - requests_before} requests sent to the sink')
+    return result
+
+
+async def bench_faults(modmail, sink: Sink, args) -> Result:
+    result = Result(f'faults: {args.users} DMs and {args.replies} replies while {args.failures} sends fail '
+                    f'with 503 or 429')
+    # other users than the other scenarios, so no reply lock or anti-spam state carries over
+    users = make_users(modmail, sink, args.users, first_id=2000000)
+    staff = FakeMember(sink, 2, nick='staff')
+    channel = modmail.client.channel
+    calls = []
+    for user in users:
+        message = FakeMessage(sink, user, FakeDMChannel(user), f'help from {user.id}')
+        calls.append(lambda m=message: modmail.on_message(m))
+    for i, user in enumerate(users[:args.replies]):
+        message = FakeMessage(sink, staff, channel, f'?{user.id} hello')
+        message.id = 3000000 + i
+        channel.messages[message.id] = message
+        calls.append(lambda m=message: modmail.on_message(m))
+
+    handler_errors = 0
+
+    async def call_handler(call):
+        nonlocal handler_errors
+        # disnake only logs what a handler raises, so count it instead of stopping the scenario
+        try:
+            await call()
+        except disnake.HTTPException:
+            handler_errors += 1
+
+    # short backoff, so the scenario measures the retry path and not the waiting
+    modmail.outbox.base_backoff = 0.05
+    if not modmail.outbox._task:
+        modmail.outbox.start()
+    counters = modmail.metrics.counters
+    deferred_before = counters.get('modmail_outbox_deferred_total', 0)
+    retries_before = counters.get('modmail_outbox_retries_total', 0)
+    sink.failures = args.failures
+    start = perf_counter()
+    await measure(result, [lambda c=c: call_handler(c) for c in calls], args.concurrency)
+    while await modmail.database.read(modmail._select_outbox) and perf_counter() - start < 60:
+        await asyncio.sleep(0.01)
+    left = len(await modmail.database.read(modmail._select_outbox))
+    result.notes.append(f'{counters.get("modmail_outbox_deferred_total", 0) - deferred_before:.0f} deferred, '
+                        f'{counters.get("modmail_outbox_retries_total", 0) - retries_before:.0f} retries, '
+                        f'{left} left in the outbox after {perf_counter() - start:.3f}s')
+    result.notes.append(f'{handler_errors} handler errors, {sink.failures} injected failures unused')
+    sink.failures = 0
+    return result
+
+
+async def bench_gen_color(modmail, sink: Sink, args) -> Result:
+    result = Result(f'gen_color: {args.iterations} calls')
+
+    async def call(user_id):
+        modmail.gen_color(user_id)
+
+    await measure(result, [lambda i=i: call(1000 + i) for i in range(args.iterations)], 1)
+    return result
+
+
+async def bench_profiles(modmail, sink: Sink, args) -> Result:
+    result = Result(f'profiles: {args.iterations} lookups over {args.users} users')
+    users = make_users(modmail, sink, args.users)
+    modmail.profiles.clear()
+    rng_state = random.getstate()
+
+    async def call(user):
+        modmail.profiles.get(user)
+
+    await measure(result, [lambda i=i: call(users[i % len(users)]) for i in range(args.iterations)], 1)
+    result.notes.append('global random state ' + ('untouched' if random.getstate() == rng_state else 'changed'))
+    return result
+
+
+async def bench_ignore_db(modmail, sink: Sink, args) -> Result:
+    result = Result(f'ignore_db: {args.iterations} add/is/remove cycles')
+
+    async def cycle(user_id):
+        await modmail.add_ignore(user_id, 'benchmark')
+        await modmail.is_ignored(user_id)
+        await modmail.remove_ignore(user_id)
+
+    await measure(result, [lambda i=i: cycle(5000000 + i) for i in range(args.iterations)], args.concurrency)
+    return result
+
+
+async def bench_ignore_bulk(modmail, sink: Sink, args) -> Result:
+    result = Result(f'ignore_bulk: ?ignore and ?unignore with {args.iterations} IDs each')
+    staff = FakeMember(sink, 2, nick='staff')
+    # long enough to count as user IDs after the first one
+    user_ids = ' '.join(str(100000000000000000 + i) for i in range(args.iterations))
+    calls = [lambda: modmail.on_message(FakeMessage(sink, staff, modmail.client.channel, f'?qignore {user_ids}')),
+             lambda: modmail.on_message(FakeMessage(sink, staff, modmail.client.channel, f'?unignore {user_ids}'))]
+    await measure(result, calls, 1)
+    return result
+
+
+scenarios = {
+    'dm_storm': bench_dm_storm,
+    'typing_flood': bench_typing_flood,
+    'staff_replies': bench_staff_replies,
+    'forward_file': bench_forward_file,
+    'faults': bench_faults,
+    'gen_color': bench_gen_color,
+    'profiles': bench_profiles,
+    'ignore_db': bench_ignore_db,
+    'ignore_bulk': bench_ignore_bulk,
+}
+
+
+async def main(modmail, args):
+    sink = Sink(args.latency)
+    await sink.start()
+    modmail.client = FakeClient(sink, args.channels)
+    await modmail.prepare()
+    modmail.set_channels(modmail.settings)
+    try:
+        for name in args.scenarios or scenarios:
+            result = await scenarios[name](modmail, sink, args)
+            result.report()
+    finally:
+        await sink.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline benchmark for the discord-mod-mail handlers.')
+    parser.add_argument('scenarios', nargs='*', choices=[[]] + list(scenarios), help='scenarios to run')
+    parser.add_argument('--users', type=int, default=200, help='users in storms and floods')
+    parser.add_argument('--messages', type=int, default=5, help='messages or typing events per user')
+    parser.add_argument('--replies', type=int, default=20, help='staff replies')
+    parser.add_argument('--attachments', type=int, default=5, help='attachments per staff reply')
+    parser.add_argument('--attachment-size', type=int, default=0x40000, help='bytes per attachment')
+    parser.add_argument('--iterations', type=int, default=2000,
+                        help='iterations for gen_color, profiles and the ignore scenarios')
+    parser.add_argument('--failures', type=int, default=20, help='sends that fail in the faults scenario')
+    parser.add_argument('--channels', type=int, default=1, help='mod-mail channels to spread DMs across')
+    parser.add_argument('--concurrency', type=int, default=100, help='handlers running at once')
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds the sink waits per request')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        modmail = load_modmail(data_dir, args.channels)
+        tracemalloc.start()
+        try:
+            asyncio.run(main(modmail, args))
+        finally:
+            tracemalloc.stop()
+            modmail.database.close()
+            modmail.spool.clear()
@@ -2,23 +2,42 @@
 
 import asyncio
 import configparser
+import csv
+import hashlib
+import json
+import logging
 import random
 import sqlite3
-from os import environ
-from os.path import join
-from subprocess import check_output, CalledProcessError
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from io import BytesIO, StringIO, TextIOWrapper
+from os import environ, fdopen, remove, replace
+from os.path import abspath, dirname, isfile, join
+from queue import Empty, SimpleQueue
 from sys import version_info
-from tempfile import TemporaryFile
-from typing import TYPE_CHECKING
+from shutil import rmtree
+from tempfile import TemporaryFile, mkdtemp, mkstemp
+from threading import Thread
+from time import monotonic, perf_counter, time
+from typing import TYPE_CHECKING, NamedTuple
 
+import aiohttp
 import disnake
 
 if TYPE_CHECKING:
-    from typing import List, Optional, Tuple
+    from typing import Any, Awaitable, BinaryIO, Callable, Deque, Dict, List, Optional, Set, Tuple, Union
 
 
 version = '1.3.13'
 
+# everything in the startup message is measured from here
+startup_started = perf_counter()
+# phase -> seconds, in the order they finished
+startup_times = {}  # type: Dict[str, float]
+
+script_dir = dirname(abspath(__file__))
+
 is_docker = environ.get('IS_DOCKER', 0)
 data_dir = environ.get('MODMAIL_DATA_DIR', '.')
 
@@ -28,123 +47,2067 @@ pyver = '{0[0]}.{0[1]}.{0[2]}'.format(version_info)
 if version_info[3] != 'final':
     pyver += '{0[3][0]}{0[4]}'.format(version_info)
 
+
+def read_git_head(git_dir: str) -> 'Tuple[str, str]':
+    """Get the commit and branch that HEAD points to, the same as ``git rev-parse HEAD`` and
+    ``git rev-parse --abbrev-ref HEAD`` but without starting git."""
+    if isfile(git_dir):
+        # worktrees and submodules have a file pointing to the real directory
+        with open(git_dir, 'r', encoding='utf-8') as f:
+            git_dir = join(dirname(git_dir), f.read().strip()[len('gitdir: '):])
+    with open(join(git_dir, 'HEAD'), 'r', encoding='utf-8') as f:
+        head = f.read().strip()
+    if not head.startswith('ref: '):
+        # detached HEAD
+        return head, 'HEAD'
+
+    ref = head[len('ref: '):]
+    branch = ref[len('refs/heads/'):] if ref.startswith('refs/heads/') else ref
+    # a worktree keeps its own HEAD, but refs are shared with the main repository
+    try:
+        with open(join(git_dir, 'commondir'), 'r', encoding='utf-8') as f:
+            git_dir = join(git_dir, f.read().strip())
+    except FileNotFoundError:
+        pass
+    try:
+        with open(join(git_dir, ref), 'r', encoding='utf-8') as f:
+            return f.read().strip(), branch
+    except FileNotFoundError:
+        pass
+    # refs that didn't change since the last gc only exist in packed-refs
+    with open(join(git_dir, 'packed-refs'), 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.rstrip('\n').endswith(' ' + ref):
+                return line.split(' ', 1)[0], branch
+    raise FileNotFoundError(f'{ref} not found')
+
+
 if is_docker:
     commit = environ.get('COMMIT_SHA', '<unknown>')
     branch = environ.get('COMMIT_BRANCH', '<unknown>')
 else:
     try:
-        commit = check_output(['git', 'rev-parse', 'HEAD']).decode('ascii')[:-1]
-    except CalledProcessError as e:
-        print(f'Checking for git commit failed: {type(e).__name__} {e}')
-        commit = '<unknown>'
-    except FileNotFoundError as e:
-        print('git not found, not showing commit')
+        commit, branch = read_git_head(join(script_dir, '.git'))
+    except OSError as e:
+        print(f'Checking for git commit and branch failed: {type(e).__name__} {e}')
         commit = '<unknown>'
-
-    try:
-        branch = check_output(['git', 'rev-parse', '--abbrev-ref', 'HEAD']).decode()[:-1]
-    except CalledProcessError as e:
-        print(f'Checking for git branch failed: {type(e).__name__} {e}')
-        branch = '<unknown>'
-    except FileNotFoundError as e:
-        print('git not found, not showing branch')
         branch = '<unknown>'
 
 print(f'Starting discord-mod-mail {version}!')
 
-config = configparser.ConfigParser()
-config.read(join(data_dir, 'config.ini'))
+config_file = join(data_dir, 'config.ini')
+
+
+class Settings(NamedTuple):
+    """A validated snapshot of config.ini.
+
+    Everything reads the current snapshot from ``settings``, which ?reload replaces as a whole.
+    """
+    token: str
+    channel_id: int
+    command_prefix: str
+    anonymous_staff: bool
+    playing: str
+    post_startup_message: bool
+    low_memory: bool
+    member_cache_size: int
+    member_cache_ttl: float
+    anti_spam_messages: int
+    anti_spam_seconds: float
+    # only used if burst or sustain is set, otherwise messages and seconds are a sliding window
+    anti_spam_token_bucket: bool
+    anti_spam_burst: float
+    anti_spam_sustain: float
+    attachment_concurrency: int
+    attachment_memory_limit: int
+    attachment_spool_size: int
+    attachment_max_reply_size: int
+    attachment_progress_interval: float
+    metrics_host: str
+    metrics_port: int
+    sharded: bool
+    shard_count: int
+    # channel_id first, then the extra [Routing] channels
+    channel_ids: 'Tuple[int, ...]'
+    # guild ID -> channel ID for DMs from members of that guild
+    guild_channels: 'Dict[int, int]'
+
+
+def load_settings() -> Settings:
+    """Read config.ini into a new Settings snapshot. Raises ValueError if anything is missing or invalid."""
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    routing = config['Routing'] if config.has_section('Routing') else {}
+    try:
+        extra_channel_ids = [int(x) for x in routing.get('channels', '').replace(',', ' ').split()]
+        # every other option in [Routing] is a guild ID
+        guild_channels = {int(k): int(v) for k, v in routing.items() if k != 'channels'}
+    except ValueError as e:
+        raise ValueError(f'[Routing] must only have channel and guild IDs: {e}')
+    try:
+        main = config['Main']
+        anti_spam_config = config['AntiSpam']
+        # the bucket defaults come close to the window, where reaching `messages` within `seconds` ignores the user
+        anti_spam_messages = anti_spam_config.getint('messages')
+        anti_spam_seconds = anti_spam_config.getfloat('seconds')
+        channel_ids = [main.getint('channel_id')] + extra_channel_ids
+        new_settings = Settings(
+            token=main['token'],
+            channel_id=main.getint('channel_id'),
+            command_prefix=main['command_prefix'],
+            anonymous_staff=main.getboolean('anonymous_staff', fallback=False),
+            playing=main['playing'],
+            post_startup_message=main.getboolean('post_startup_message', fallback=True),
+            low_memory=main.getboolean('low_memory', fallback=False),
+            member_cache_size=main.getint('member_cache_size', fallback=1024),
+            member_cache_ttl=main.getfloat('member_cache_ttl', fallback=300.0),
+            anti_spam_messages=anti_spam_messages,
+            anti_spam_seconds=anti_spam_seconds,
+            anti_spam_token_bucket='burst' in anti_spam_config or 'sustain' in anti_spam_config,
+            anti_spam_burst=anti_spam_config.getfloat('burst', fallback=anti_spam_messages - 1),
+            anti_spam_sustain=anti_spam_config.getfloat('sustain',
+                                                        fallback=(anti_spam_messages - 1) / anti_spam_seconds),
+            attachment_concurrency=config.getint('Attachments', 'concurrency', fallback=4),
+            attachment_memory_limit=config.getint('Attachments', 'memory_limit', fallback=0x100000),
+            attachment_spool_size=config.getint('Attachments', 'spool_size', fallback=0x10000000),
+            attachment_max_reply_size=config.getint('Attachments', 'max_reply_size', fallback=0x800000 * 10),
+            attachment_progress_interval=config.getfloat('Attachments', 'progress_interval', fallback=1.0),
+            metrics_host=config.get('Metrics', 'host', fallback='127.0.0.1'),
+            metrics_port=config.getint('Metrics', 'port', fallback=0),
+            sharded=main.getboolean('sharded', fallback=False),
+            shard_count=main.getint('shard_count', fallback=0),
+            channel_ids=tuple(dict.fromkeys(channel_ids)),
+            guild_channels=guild_channels,
+        )
+    except KeyError as e:
+        raise ValueError(f'missing section or option {e}')
+    except ZeroDivisionError:
+        raise ValueError('[AntiSpam] seconds must be more than 0')
+    except TypeError:
+        # getint/getfloat without a fallback return None for missing options
+        raise ValueError('[AntiSpam] messages and seconds are required')
+
+    missing = [name for name, value in new_settings._asdict().items() if value is None]
+    if missing:
+        raise ValueError(f'missing option {", ".join(missing)}')
+    if not new_settings.command_prefix:
+        raise ValueError('command_prefix must not be empty')
+    if new_settings.anti_spam_burst < 1 or new_settings.anti_spam_sustain <= 0:
+        raise ValueError('[AntiSpam] must allow at least one message')
+    if new_settings.member_cache_size < 1 or new_settings.attachment_concurrency < 1:
+        raise ValueError('member_cache_size and [Attachments] concurrency must be at least 1')
+    return new_settings
+
+
+try:
+    settings = load_settings()
+except ValueError as e:
+    raise SystemExit(f'Invalid {config_file}: {e}')
+
+# low memory mode doesn't keep any guild members around, members are fetched when needed instead
+intents = disnake.Intents(guilds=True, members=not settings.low_memory, messages=True, message_content=True,
+                          dm_typing=True)
+
+client_options = {'activity': disnake.Game(name=settings.playing), 'max_messages': 100, 'intents': intents}
+if settings.low_memory:
+    client_options.update(chunk_guilds_at_startup=False, member_cache_flags=disnake.MemberCacheFlags.none())
+
+if settings.sharded:
+    # one gateway connection per shard, shard_count = 0 uses the count Discord recommends
+    client = disnake.AutoShardedClient(shard_count=settings.shard_count or None, **client_options)
+else:
+    client = disnake.Client(**client_options)
+# the channel from channel_id, where the startup message and anything not about a specific user goes
+client.channel: disnake.TextChannel
 
-post_startup_message = config['Main'].getboolean('post_startup_message', fallback=True)
+client.already_ready = False
 
-intents = disnake.Intents(guilds=True, members=True, messages=True, message_content=True, dm_typing=True)
+startup_times['config'] = perf_counter() - startup_started
 
-client = disnake.Client(activity=disnake.Game(name=config['Main']['playing']), max_messages=100, intents=intents)
-client.channel: disnake.TextChannel
 
-client.already_ready = False
+class Histogram:
+    """Cumulative histogram with fixed buckets, in the shape Prometheus expects."""
 
-client.last_id = 'uninitialized'
+    # seconds, from a fast SQLite call to a slow attachment upload
+    default_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, buckets: 'Tuple[float, ...]' = default_buckets):
+        self.buckets = buckets
+        # the last slot is everything above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket that holds the q-th quantile."""
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    """Counters, histograms and gauges for the hot paths, exposed through ?stats and optionally over HTTP.
+
+    Updates are plain attribute and dict operations, so they are cheap enough to do on every message. The database
+    thread also records into this, and the GIL is enough to keep that consistent for monitoring purposes.
+    """
+
+    def __init__(self):
+        self.counters = {}  # type: Dict[str, float]
+        self.histograms = {}  # type: Dict[str, Histogram]
+        self.gauges = {}  # type: Dict[str, Callable[[], float]]
+
+    def inc(self, name: str, amount: float = 1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name: str, value: float, buckets: 'Tuple[float, ...]' = Histogram.default_buckets):
+        try:
+            histogram = self.histograms[name]
+        except KeyError:
+            histogram = self.histograms[name] = Histogram(buckets)
+        histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start)
+
+    def gauge(self, name: str, func: 'Callable[[], float]'):
+        self.gauges[name] = func
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name} {value}')
+        for name, func in sorted(self.gauges.items()):
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {func()}')
+        for name, histogram in sorted(self.histograms.items()):
+            lines.append(f'# TYPE {name} histogram')
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{le="+Inf"}} {histogram.count}')
+            lines.append(f'{name}_sum {histogram.sum}')
+            lines.append(f'{name}_count {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def render_summary(self) -> str:
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            lines.append(f'{name}: {value:g}')
+        for name, func in sorted(self.gauges.items()):
+            lines.append(f'{name}: {func():g}')
+        for name, histogram in sorted(self.histograms.items()):
+            if histogram.count:
+                lines.append(f'{name}: {histogram.count} observed, avg {histogram.sum / histogram.count:.4f}, '
+                             f'p50 <= {histogram.quantile(0.5):g}, p99 <= {histogram.quantile(0.99):g}')
+        return '\n'.join(lines)
+
+
+metrics = Metrics()
+
+
+class RateLimitCounter(logging.Handler):
+    """Counts the rate limit warnings disnake logs, since it doesn't have an event for them."""
+
+    def emit(self, record: logging.LogRecord):
+        if not isinstance(record.msg, str):
+            return
+        # every 429 logs the first one, and a global one logs the second one right after it
+        if record.msg.startswith('We are being rate limited'):
+            metrics.inc('modmail_rate_limits_total')
+            if record.args:
+                metrics.observe('modmail_rate_limit_retry_seconds', float(record.args[0]))
+        elif record.msg.startswith('Global rate limit has been hit'):
+            metrics.inc('modmail_global_rate_limits_total')
+
+
+logging.getLogger('disnake.http').addHandler(RateLimitCounter(logging.WARNING))
+
+
+async def start_metrics_server(host: str, port: int):
+    # only importing aiohttp.web if needed
+    from aiohttp import web
+
+    async def handle_metrics(request):
+        return web.Response(body=metrics.render_prometheus().encode('utf-8'),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f'Serving metrics on http://{host}:{port}/metrics')
 
-db = sqlite3.connect(database_file)
-with db:
-    if db.execute('PRAGMA user_version').fetchone()[0] == 0:
-        print('Setting up', database_file)
-        db.execute('PRAGMA application_id = 0x4D6F644D')  # ModM
-        db.execute('PRAGMA user_version = 1')
-        with open('schema.sql', 'r', encoding='utf-8') as f:
-            db.executescript(f.read())
 
+class Database:
+    """Runs all SQLite work on a dedicated thread so commits and fsyncs never stall the event loop.
+
+    Writes that arrive within ``batch_window`` seconds of each other are grouped into one transaction, each inside
+    its own savepoint so one failing write does not roll back the others.
+    """
+
+    def __init__(self, path: str, batch_window: float = 0.005):
+        self.path = path
+        self.batch_window = batch_window
+        self._queue = SimpleQueue()
+        self._thread = Thread(target=self._run, name='modmail-db', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _submit(self, write: bool, func: 'Callable[..., Any]', args: tuple) -> 'asyncio.Future':
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.put((write, func, args, loop, future))
+        return future
+
+    def read(self, func: 'Callable[..., Any]', *args) -> 'asyncio.Future':
+        """Run ``func(connection, *args)`` on the database thread outside of a transaction."""
+        return self._submit(False, func, args)
+
+    def write(self, func: 'Callable[..., Any]', *args) -> 'asyncio.Future':
+        """Run ``func(connection, *args)`` on the database thread inside a (possibly shared) transaction."""
+        return self._submit(True, func, args)
+
+    @staticmethod
+    def _resolve(future: 'asyncio.Future', result, exc: 'Optional[BaseException]'):
+        if future.cancelled():
+            return
+        if exc is not None:
+            future.set_exception(exc)
+        else:
+            future.set_result(result)
+
+    @classmethod
+    def _deliver(cls, job: tuple, result, exc: 'Optional[BaseException]' = None):
+        loop, future = job[3], job[4]
+        try:
+            loop.call_soon_threadsafe(cls._resolve, future, result, exc)
+        except RuntimeError:
+            # the loop was closed while the job was running, nobody is waiting on it anymore
+            pass
+
+    def _run_reads(self, conn: sqlite3.Connection, jobs: 'List[tuple]'):
+        for job in jobs:
+            try:
+                with metrics.timer('modmail_db_read_seconds'):
+                    result = job[1](conn, *job[2])
+            except Exception as e:
+                self._deliver(job, None, e)
+            else:
+                self._deliver(job, result)
+
+    def _run_writes(self, conn: sqlite3.Connection, jobs: 'List[tuple]'):
+        metrics.inc('modmail_db_writes_total', len(jobs))
+        metrics.inc('modmail_db_write_batches_total')
+        outcomes = []
+        start = perf_counter()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for job in jobs:
+                conn.execute('SAVEPOINT job')
+                try:
+                    result = job[1](conn, *job[2])
+                except Exception as e:
+                    conn.execute('ROLLBACK TO job')
+                    outcomes.append((job, None, e))
+                else:
+                    outcomes.append((job, result, None))
+                conn.execute('RELEASE job')
+            conn.execute('COMMIT')
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            for job in jobs:
+                self._deliver(job, None, e)
+            return
+        finally:
+            metrics.observe('modmail_db_write_batch_seconds', perf_counter() - start)
+
+        for job, result, exc in outcomes:
+            self._deliver(job, result, exc)
+
+    def _run(self):
+        # isolation_level=None means transactions are managed by _run_writes instead of the sqlite3 module,
+        # and the statement cache keeps the handful of queries this bot uses prepared
+        conn = sqlite3.connect(self.path, isolation_level=None, cached_statements=64)
+        conn.execute('PRAGMA synchronous = NORMAL')
+        running = True
+        while running:
+            job = self._queue.get()
+            if job is None:
+                break
+            if not job[0]:
+                self._run_reads(conn, [job])
+                continue
+
+            writes = [job]
+            reads = []
+            deadline = monotonic() + self.batch_window
+            while True:
+                timeout = deadline - monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    job = self._queue.get(timeout=timeout)
+                except Empty:
+                    break
+                if job is None:
+                    running = False
+                    break
+                if job[0]:
+                    writes.append(job)
+                else:
+                    # reads submitted after these writes should see them, so stop batching here
+                    reads.append(job)
+                    break
+
+            self._run_writes(conn, writes)
+            self._run_reads(conn, reads)
+
+        conn.close()
+
+
+# each entry upgrades the database by one user_version, starting from the version schema.sql creates
+migrations = [
+    # 1 -> 2: append-only conversation log, paged by ?history
+    """
+    CREATE TABLE messages (
+      id INTEGER PRIMARY KEY,
+      user_id INTEGER NOT NULL,
+      timestamp INTEGER NOT NULL,
+      author_id INTEGER NOT NULL,
+      from_staff INTEGER NOT NULL,
+      content TEXT NOT NULL,
+      attachments TEXT
+    );
+    CREATE INDEX messages_user_timestamp ON messages (user_id, timestamp);
+    CREATE TRIGGER messages_no_update BEFORE UPDATE ON messages
+      BEGIN SELECT RAISE(ABORT, 'messages is append-only'); END;
+    CREATE TRIGGER messages_no_delete BEFORE DELETE ON messages
+      BEGIN SELECT RAISE(ABORT, 'messages is append-only'); END;
+    """,
+    # 2 -> 3: relays and replies waiting for Discord to confirm them
+    """
+    CREATE TABLE outbox (
+      id INTEGER PRIMARY KEY,
+      kind TEXT NOT NULL,
+      recipient INTEGER NOT NULL,
+      payload TEXT NOT NULL,
+      attempts INTEGER NOT NULL,
+      next_attempt REAL NOT NULL
+    );
+    """,
+]
+
+
+def setup_database(conn: sqlite3.Connection):
+    """Create or upgrade the database. This runs as the first job of the database thread, while the client logs in."""
+    user_version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if user_version > len(migrations) + 1:
+        raise RuntimeError(f'{database_file} is version {user_version}, which is newer than this version of the bot')
+
+    if user_version == 0:
+        print('Setting up', database_file)
+        with open(join(script_dir, 'schema.sql'), 'r', encoding='utf-8') as f:
+            # executescript only commits a transaction that was already open, this one stays open for the import
+            conn.executescript(f'BEGIN; PRAGMA application_id = 0x4D6F644D; {f.read()}')  # ModM
         try:
             print('Converting ignored.json')
             with open('ignored.json', 'r') as f:
-                # only importing json if needed
-                import json
                 ignored = json.load(f)
-                del json
 
-            db.executemany('INSERT INTO ignored VALUES (?, 1, NULL)', ((x,) for x in ignored))
+            conn.executemany('INSERT INTO ignored VALUES (?, 1, NULL)', ((x,) for x in ignored))
             print('Done!')
 
         except FileNotFoundError:
             pass
+        conn.execute('PRAGMA user_version = 1')
+        conn.execute('COMMIT')
+        user_version = 1
+
+    for version_from, migration in enumerate(migrations[user_version - 1:], user_version):
+        print(f'Upgrading {database_file} from version {version_from} to {version_from + 1}')
+        # executescript commits on its own, so the version is bumped in the same script
+        conn.executescript(f'BEGIN; {migration}; PRAGMA user_version = {version_from + 1}; COMMIT;')
+
+    # WAL lets the database thread commit without blocking readers, and the setting is stored in the file itself
+    conn.execute('PRAGMA journal_mode = WAL')
 
 
-def is_ignored(user_id: int) -> 'Optional[Tuple[int, Optional[str]]]':
-    with db:
-        return db.execute('SELECT quiet, reason FROM ignored WHERE user_id = ?', (user_id,)).fetchone()
+def _select_ignored(conn: sqlite3.Connection) -> 'List[Tuple[int, int, Optional[str]]]':
+    return conn.execute('SELECT user_id, quiet, reason FROM ignored').fetchall()
 
 
-def add_ignore(user_id: int, reason: str = None, is_quiet: bool = False) -> bool:
+def _insert_ignore(conn: sqlite3.Connection, user_id: int, is_quiet: bool, reason: 'Optional[str]') -> bool:
     try:
-        with db:
-            print(user_id)
-            db.execute('INSERT INTO ignored VALUES (?, ?, ?)', (user_id, is_quiet, reason))
-            return True
+        conn.execute('INSERT INTO ignored VALUES (?, ?, ?)', (user_id, is_quiet, reason))
+        return True
     except sqlite3.IntegrityError:
         return False
 
 
-def remove_ignore(user_id: int) -> int:
-    with db:
-        return db.execute('DELETE FROM ignored WHERE user_id = ?', (user_id,)).rowcount
+def _delete_ignore(conn: sqlite3.Connection, user_id: int) -> int:
+    return conn.execute('DELETE FROM ignored WHERE user_id = ?', (user_id,)).rowcount
+
+
+def _insert_ignores(conn: sqlite3.Connection, rows: 'List[Tuple[int, bool, Optional[str]]]') -> int:
+    # users that are already ignored keep their current reason
+    return conn.executemany('INSERT OR IGNORE INTO ignored VALUES (?, ?, ?)', rows).rowcount
+
+
+def _delete_ignores(conn: sqlite3.Connection, user_ids: 'List[int]') -> int:
+    return conn.executemany('DELETE FROM ignored WHERE user_id = ?', ((x,) for x in user_ids)).rowcount
+
+
+def _export_ignored(conn: sqlite3.Connection, fp: 'BinaryIO', fmt: str) -> int:
+    """Write the ignored table to a file as CSV or JSON, one row at a time. Returns how many rows were written."""
+    count = 0
+    text = TextIOWrapper(fp, encoding='utf-8', newline='')
+    cursor = conn.execute('SELECT user_id, quiet, reason FROM ignored ORDER BY user_id')
+    if fmt == 'json':
+        text.write('[')
+        for user_id, quiet, reason in cursor:
+            text.write(',\n' if count else '\n')
+            text.write(json.dumps({'user_id': user_id, 'quiet': bool(quiet), 'reason': reason}))
+            count += 1
+        text.write('\n]\n')
+    else:
+        writer = csv.writer(text)
+        writer.writerow(('user_id', 'quiet', 'reason'))
+        for row in cursor:
+            writer.writerow(row)
+            count += 1
+    text.flush()
+    # leave fp open for the caller
+    text.detach()
+    return count
+
+
+# user_id -> (quiet, reason), kept in sync with the ignored table so lookups never touch the disk
+ignored_users = {}  # type: Dict[int, Tuple[int, Optional[str]]]
+
+
+def _set_ignored(rows: 'List[Tuple[int, int, Optional[str]]]'):
+    ignored_users.clear()
+    ignored_users.update((user_id, (quiet, reason)) for user_id, quiet, reason in rows)
+
+
+def _insert_outbox(conn: sqlite3.Connection, kind: str, recipient: int, payload: str, deferred: bool,
+                   now: float) -> int:
+    return conn.execute('INSERT INTO outbox (kind, recipient, payload, attempts, next_attempt) VALUES (?, ?, ?, ?, ?)',
+                        (kind, recipient, payload, int(deferred), now)).lastrowid
+
+
+def _defer_outbox(conn: sqlite3.Connection, entry_id: int, next_attempt: float):
+    conn.execute('UPDATE outbox SET attempts = attempts + 1, next_attempt = ? WHERE id = ?', (next_attempt, entry_id))
+
+
+def _delete_outbox(conn: sqlite3.Connection, entry_id: int):
+    conn.execute('DELETE FROM outbox WHERE id = ?', (entry_id,))
+
+
+def _select_outbox(conn: sqlite3.Connection) -> 'List[Tuple[int, str, int, str, int, float]]':
+    return conn.execute('SELECT id, kind, recipient, payload, attempts, next_attempt FROM outbox '
+                        'WHERE attempts > 0 ORDER BY id').fetchall()
+
+
+def _select_deferred_recipients(conn: sqlite3.Connection) -> 'List[int]':
+    return [r for r, in conn.execute('SELECT DISTINCT recipient FROM outbox WHERE attempts > 0')]
+
+
+def _recover_outbox(conn: sqlite3.Connection) -> 'Set[int]':
+    # anything that was still on its first attempt when the bot stopped is up to the retry loop now
+    conn.execute('UPDATE outbox SET attempts = 1 WHERE attempts = 0')
+    return set(_select_deferred_recipients(conn))
+
+
+def _select_recent_users(conn: sqlite3.Connection, limit: int) -> 'List[int]':
+    # IDs only go up, so the newest messages are read backwards from the end of the table instead of grouping all of
+    # it, and this costs the same however long the log gets; a window of 10 messages per user is usually plenty
+    return [u for u, in conn.execute('SELECT user_id FROM (SELECT id, user_id FROM messages ORDER BY id DESC LIMIT ?) '
+                                     'GROUP BY user_id ORDER BY MAX(id) DESC LIMIT ?', (limit * 10, limit))]
+
+
+database = Database(database_file)
+database.start()
+metrics.gauge('modmail_db_queue_depth', lambda: database._queue.qsize())
+
+
+async def load_ignored() -> int:
+    """Reload the ignored table into memory."""
+    _set_ignored(await database.read(_select_ignored))
+    return len(ignored_users)
+
+
+async def is_ignored(user_id: int) -> 'Optional[Tuple[int, Optional[str]]]':
+    return ignored_users.get(user_id)
+
+
+async def add_ignore(user_id: int, reason: str = None, is_quiet: bool = False) -> bool:
+    if not await database.write(_insert_ignore, user_id, is_quiet, reason):
+        return False
+    ignored_users[user_id] = (int(is_quiet), reason)
+    return True
+
+
+async def remove_ignore(user_id: int) -> int:
+    count = await database.write(_delete_ignore, user_id)
+    ignored_users.pop(user_id, None)
+    return count
+
+
+async def add_ignores(rows: 'List[Tuple[int, bool, Optional[str]]]') -> int:
+    """Ignore many users in one transaction. Returns how many were not already ignored."""
+    count = await database.write(_insert_ignores, rows)
+    for user_id, is_quiet, reason in rows:
+        if user_id not in ignored_users:
+            ignored_users[user_id] = (int(is_quiet), reason)
+    return count
+
+
+async def remove_ignores(user_ids: 'List[int]') -> int:
+    """Stop ignoring many users in one transaction. Returns how many were ignored."""
+    count = await database.write(_delete_ignores, user_ids)
+    for user_id in user_ids:
+        ignored_users.pop(user_id, None)
+    return count
+
+
+def _insert_message(conn: sqlite3.Connection, row: tuple):
+    conn.execute('INSERT INTO messages (user_id, timestamp, author_id, from_staff, content, attachments) '
+                 'VALUES (?, ?, ?, ?, ?, ?)', row)
+
+
+def _report_write_failure(future: 'asyncio.Future'):
+    if not future.cancelled() and future.exception():
+        print(f'Database write failed: {type(future.exception()).__name__} {future.exception()}')
+
+
+def log_message(user_id: int, author_id: int, message: disnake.Message, from_staff: bool, content: str):
+    """Append a relayed DM or staff reply to the conversation log.
+
+    This doesn't wait for the write, it is committed together with whatever else the database thread is writing.
+    """
+    attachments = '\n'.join(a.url for a in message.attachments) or None
+    row = (user_id, int(message.created_at.timestamp() * 1000), author_id, from_staff, content, attachments)
+    database.write(_insert_message, row).add_done_callback(_report_write_failure)
+
+
+history_page_size = 10
+
+
+def _select_history(conn: sqlite3.Connection, user_id: int, cursor: 'Optional[Tuple[int, int]]',
+                    skip_pages: int) -> 'Tuple[Optional[Tuple[int, int]], List[tuple]]':
+    # walking forward from a known cursor only touches the index, a page at a time
+    for _ in range(skip_pages):
+        if cursor:
+            key = conn.execute('SELECT timestamp, id FROM messages WHERE user_id = ? AND (timestamp, id) < (?, ?) '
+                               'ORDER BY timestamp DESC, id DESC LIMIT 1 OFFSET ?',
+                               (user_id, *cursor, history_page_size - 1)).fetchone()
+        else:
+            key = conn.execute('SELECT timestamp, id FROM messages WHERE user_id = ? '
+                               'ORDER BY timestamp DESC, id DESC LIMIT 1 OFFSET ?',
+                               (user_id, history_page_size - 1)).fetchone()
+        if not key:
+            return None, []
+        cursor = key
+
+    if cursor:
+        rows = conn.execute('SELECT id, timestamp, author_id, from_staff, content, attachments FROM messages '
+                            'WHERE user_id = ? AND (timestamp, id) < (?, ?) ORDER BY timestamp DESC, id DESC LIMIT ?',
+                            (user_id, *cursor, history_page_size)).fetchall()
+    else:
+        rows = conn.execute('SELECT id, timestamp, author_id, from_staff, content, attachments FROM messages '
+                            'WHERE user_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?',
+                            (user_id, history_page_size)).fetchall()
+    return cursor, rows
+
+
+async def get_history(user_id: int, page: int = 1, cursor: 'Optional[Tuple[int, int]]' = None) -> 'List[tuple]':
+    """Get a page of the conversation log with a user, newest first. The page is counted from the (timestamp, id)
+    cursor if there is one, or from the newest message.
+
+    Nothing is cached between calls, since messages logged in the meantime would shift every page.
+    """
+    _, rows = await database.read(_select_history, user_id, cursor, page - 1)
+    return rows
+
+
+async def prepare() -> 'List[int]':
+    """Set up the database and load what is kept in memory from it. Nothing here needs the gateway, so it runs
+    while the client logs in. Returns the users that most recently used mod-mail, to warm the member cache with."""
+    start = perf_counter()
+    await database.read(setup_database)
+    count, outbox.blocked, recent_users = await asyncio.gather(
+        load_ignored(), database.write(_recover_outbox),
+        database.read(_select_recent_users, settings.member_cache_size))
+    print(f'Loaded {count} ignored users.')
+    if outbox.blocked:
+        print(f'{len(outbox.blocked)} recipients have undelivered messages in the outbox.')
+    startup_times['database'] = perf_counter() - start
+    return recent_users
+
+
+def format_startup_times() -> str:
+    return ', '.join(f'{phase} {seconds * 1000:.0f}ms' for phase, seconds in startup_times.items())
 
 
 @client.event
 async def on_ready():
     if client.already_ready:
+        # a new session replaces every cached guild, channel and member, so the old objects are stale now
+        print(f'{client.user} reconnected.')
+        missing = set_channels(settings)
+        if missing:
+            print(f'Channels with IDs {", ".join(map(str, missing))} not found after reconnecting.')
+        members.clear()
+        profiles.clear()
+        # anything that failed while disconnected can go out now
+        outbox.wake()
+        return
+    # the client starts logging in right after the config is loaded
+    startup_times['gateway'] = perf_counter() - startup_started - startup_times['config']
+    try:
+        recent_users = await client.prepared
+    except Exception as e:
+        print(f'Setting up the database failed: {type(e).__name__} {e}')
+        await client.close()
         return
-    client.channel = client.get_channel(int(config['Main']['channel_id']))
-    if not client.channel:
-        print(f'Channel with ID {config["Main"]["channel_id"]} not found.')
+    missing = set_channels(settings)
+    if missing:
+        print(f'Channels with IDs {", ".join(map(str, missing))} not found.')
         await client.close()
+        return
+    start = perf_counter()
+    found = members.warm(recent_users)
+    startup_times['member cache'] = perf_counter() - start
+    outbox.start()
+    if settings.metrics_port:
+        # the bot is still useful without metrics, like when the port is taken
+        try:
+            await start_metrics_server(settings.metrics_host, settings.metrics_port)
+        except OSError as e:
+            print(f'Serving metrics on {settings.metrics_host}:{settings.metrics_port} failed: {e}')
+    startup_times['total'] = perf_counter() - startup_started
     print('{0.user} is now ready.'.format(client))
+    print(f'Warmed the member cache with {found} of {len(recent_users)} recent users.')
     startup_message = (f'{client.user} is now ready. Version {version}, branch {branch}, commit {commit[0:7]}, '
-                       f'Python {pyver}')
-    if post_startup_message:
+                       f'Python {pyver}. Startup: {format_startup_times()}')
+    if settings.post_startup_message:
         await client.channel.send(startup_message)
     print(startup_message)
     client.already_ready = True
 
 
+# the 0x800 number is arbitrary, just in case
+# in reality, the file size needs to be like 0x200 smaller than the supposed limit
+attachment_size_limit = 0x800000
+attachment_size_diff = 0x800
+
+
+def format_size_limits(limit: int) -> str:
+    return (f'\nLimit: {limit} bytes ({limit / (1024 * 1024):.02f} MiB)'
+            f'\nRecommended Maximum: {limit - attachment_size_diff} bytes '
+            f'({(limit - attachment_size_diff) / (1024 * 1024):.02f} MiB)')
+
+
+async def check_attachments(channel: disnake.TextChannel, attachments: 'List[disnake.Attachment]') -> bool:
+    """Check attachment sizes from their metadata before downloading anything. Problems are reported to the given
+    mod-mail channel. Returns False if the reply must not be sent."""
+    error_messages = []
+    warning_messages = []
+    for a in attachments:
+        if a.size > attachment_size_limit:
+            error_messages.append(f'`{disnake.utils.escape_markdown(a.filename)}` '
+                                  f'is too large to send in a direct message.')
+        elif a.size > attachment_size_limit - 0x1000:
+            warning_messages.append(f'`{disnake.utils.escape_markdown(a.filename)}` '
+                                    f'is very close to the file size limit of the '
+                                    f'destination. It may fail to send.')
+
+    if error_messages:
+        await channel.send('\n'.join(error_messages) + format_size_limits(attachment_size_limit))
+        return False
+
+    total_size = sum(a.size for a in attachments)
+    if total_size > settings.attachment_max_reply_size:
+        await channel.send(f'Attachments add up to {total_size} bytes, which is more than the '
+                           f'{settings.attachment_max_reply_size} bytes allowed in one reply.')
+        return False
+
+    if warning_messages:
+        await channel.send('\n'.join(warning_messages) + format_size_limits(attachment_size_limit))
+
+    return True
+
+
+class AttachmentSpool:
+    """Downloaded attachments kept on disk, so a reply to several users downloads each attachment once.
+
+    Files are named by the SHA-256 of their contents, so the same file uploaded more than once is only stored once,
+    and attachment IDs point to them. The total size stays under ``max_size`` bytes by removing the least recently
+    used files. The directory is a temporary one that is removed when the bot stops.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self._directory = None  # type: Optional[str]
+        # hash -> size, least recently used first
+        self._files = OrderedDict()  # type: OrderedDict[str, int]
+        # attachment ID -> hash
+        self._ids = {}  # type: Dict[int, str]
+
+    def usable_for(self, a: disnake.Attachment) -> bool:
+        return a.size <= self.max_size
+
+    @staticmethod
+    def _write(path: str, data: bytes):
+        # written under another name first, so nobody can open a half-written file
+        fd, temp_path = mkstemp(dir=dirname(path))
+        with fdopen(fd, 'wb') as f:
+            f.write(data)
+        replace(temp_path, path)
+
+    def _add(self, digest: str, size: int) -> str:
+        path = join(self._directory, digest)
+        if digest not in self._files:
+            self._files[digest] = size
+            self.size += size
+        self._files.move_to_end(digest)
+
+        evicted = False
+        while self.size > self.max_size and len(self._files) > 1:
+            old_digest, old_size = self._files.popitem(last=False)
+            self.size -= old_size
+            evicted = True
+            try:
+                remove(join(self._directory, old_digest))
+            except OSError as e:
+                # files that are being uploaded can't be removed on every platform, they're removed with the rest
+                print(f'Failed to remove spooled attachment {old_digest}: {type(e).__name__} {e}')
+        if evicted:
+            self._ids = {k: v for k, v in self._ids.items() if v in self._files}
+        return path
+
+    async def get(self, a: disnake.Attachment) -> str:
+        """Get the path to a spooled copy of an attachment, downloading it if it isn't spooled yet."""
+        # checked from the metadata, before anything is downloaded
+        if a.size > attachment_size_limit:
+            raise ValueError(f'{a.filename} is {a.size} bytes, more than the limit of {attachment_size_limit}')
+        digest = self._ids.get(a.id)
+        if digest in self._files:
+            self._files.move_to_end(digest)
+            metrics.inc('modmail_attachment_spool_hits_total')
+            return join(self._directory, digest)
+
+        with metrics.timer('modmail_attachment_download_seconds'):
+            data = await a.read()
+        metrics.inc('modmail_attachment_download_bytes_total', len(data))
+        # hashing and writing a large file would stall the event loop, so both happen in an executor
+        loop = asyncio.get_running_loop()
+        digest = await loop.run_in_executor(None, lambda: hashlib.sha256(data).hexdigest())
+        if not self._directory:
+            self._directory = mkdtemp(prefix='modmail-spool-')
+        if digest not in self._files:
+            await loop.run_in_executor(None, self._write, join(self._directory, digest), data)
+        path = self._add(digest, len(data))
+        self._ids[a.id] = digest
+        return path
+
+    def clear(self):
+        if self._directory:
+            rmtree(self._directory, ignore_errors=True)
+        self._directory = None
+        self._files.clear()
+        self._ids.clear()
+        self.size = 0
+
+
+spool = AttachmentSpool(settings.attachment_spool_size)
+metrics.gauge('modmail_attachment_spool_bytes', lambda: spool.size)
+
+
+async def download_attachments(attachments: 'List[disnake.Attachment]',
+                               progress_msg: 'Optional[disnake.Message]' = None,
+                               spooled: bool = False) -> 'List[disnake.File]':
+    """Download attachments in parallel. Small ones are kept in memory and larger ones are written to a temporary
+    file. If ``spooled`` is set, because the same attachments will be sent again, they go through the spool instead
+    when they fit in it.
+
+    The progress message, if any, is edited at most once every ``settings.attachment_progress_interval`` seconds.
+    """
+    count = len(attachments)
+    semaphore = asyncio.Semaphore(settings.attachment_concurrency)
+    done = 0
+
+    async def download(a: disnake.Attachment) -> disnake.File:
+        nonlocal done
+        async with semaphore:
+            if spooled and spool.usable_for(a):
+                # opened right away, so it can't be removed from the spool before it is open
+                fp = open(await spool.get(a), 'rb')
+                done += 1
+                return disnake.File(fp, a.filename)
+
+            # the size is known up front, so pick memory or disk before anything is downloaded
+            fp = BytesIO() if a.size <= settings.attachment_memory_limit else TemporaryFile()
+            try:
+                with metrics.timer('modmail_attachment_download_seconds'):
+                    fp.write(await a.read())
+            except BaseException:
+                fp.close()
+                raise
+        metrics.inc('modmail_attachment_download_bytes_total', a.size)
+        fp.seek(0)
+        done += 1
+        return disnake.File(fp, a.filename)
+
+    async def report_progress():
+        reported = 0
+        while True:
+            await asyncio.sleep(settings.attachment_progress_interval)
+            if done != reported:
+                reported = done
+                await progress_msg.edit(content=f'Downloading attachments... {reported}/{count}')
+
+    tasks = [asyncio.ensure_future(download(a)) for a in attachments]
+    reporter = asyncio.ensure_future(report_progress() if progress_msg else asyncio.sleep(0))
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for task in tasks:
+            if not task.cancelled() and task.exception() is None:
+                task.result().close()
+        raise
+    finally:
+        reporter.cancel()
+
+
+class MemberResolver:
+    """Maps user IDs to the best known Member (for nicknames) or User object across every guild.
+
+    Results are kept in an LRU cache with a TTL, so repeat lookups don't scan every guild. Misses fall back to an
+    API fetch, and member update/leave events invalidate entries. With ``fetch_members`` the guild member cache is
+    not used at all, and members are fetched from the API instead, so this cache is the only one.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0, negative_ttl: float = 30.0,
+                 fetch_members: bool = False):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.fetch_members = fetch_members
+        # user_id -> (expiry, member or user, None if nobody was found)
+        self._cache = OrderedDict()  # type: OrderedDict[int, Tuple[float, Any]]
+
+    def invalidate(self, user_id: int):
+        self._cache.pop(user_id, None)
+
+    def clear(self):
+        self._cache.clear()
+
+    def cached(self, user_id: int) -> 'Optional[Union[disnake.Member, disnake.User]]':
+        """Get a user only if they are already cached, without any API calls."""
+        entry = self._cache.get(user_id)
+        if entry and entry[0] > monotonic():
+            return entry[1]
+        return None
+
+    def warm(self, user_ids: 'List[int]') -> int:
+        """Cache whoever of these users is already in the client's own member and user caches, without any API
+        calls. Returns how many were found."""
+        found = 0
+        # the least recent first, so the most recent end up at the young end of the LRU
+        for user_id in reversed(user_ids):
+            result = None if self.fetch_members else self._lookup(user_id)
+            result = result or client.get_user(user_id)
+            if result:
+                self._store(user_id, result)
+                found += 1
+        return found
+
+    def _store(self, user_id: int, result: 'Optional[Union[disnake.Member, disnake.User]]'):
+        ttl = self.ttl if result else self.negative_ttl
+        self._cache[user_id] = (monotonic() + ttl, result)
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    @staticmethod
+    def _lookup(user_id: int) -> 'Optional[disnake.Member]':
+        # prefer a member with a nickname, then any member
+        best = None
+        for guild in client.guilds:
+            member = guild.get_member(user_id)
+            if member:
+                if member.nick:
+                    return member
+                if not best:
+                    best = member
+        return best
+
+    @staticmethod
+    def _member_guilds() -> 'List[disnake.Guild]':
+        # only the guilds a member is useful for: the routed ones, then the mod-mail channel's own guild. The routed
+        # ones come first and in config order, so route() picks the same channel for the member that is found as it
+        # does from the member cache when low_memory is off
+        guild_ids = list(settings.guild_channels)
+        channel = client.get_channel(settings.channel_id)
+        if isinstance(channel, disnake.abc.GuildChannel):
+            guild_ids.append(channel.guild.id)
+        return [guild for guild in map(client.get_guild, dict.fromkeys(guild_ids)) if guild]
+
+    @classmethod
+    async def _fetch_member(cls, user_id: int) -> 'Optional[disnake.Member]':
+        # every guild is another API call and a 404 for most users, so only try the ones that matter
+        for guild in cls._member_guilds():
+            try:
+                return await guild.fetch_member(user_id)
+            except disnake.HTTPException as e:
+                # 400 is what an invalid snowflake gets
+                if e.status not in {400, 404}:
+                    raise
+        return None
+
+    @staticmethod
+    async def _fetch_user(user_id: int) -> 'Optional[disnake.User]':
+        user = client.get_user(user_id)
+        if user:
+            return user
+        try:
+            return await client.fetch_user(user_id)
+        except disnake.HTTPException as e:
+            if e.status not in {400, 404}:
+                raise
+        return None
+
+    async def resolve(self, user_id: int) -> 'Optional[Union[disnake.Member, disnake.User]]':
+        entry = self._cache.get(user_id)
+        if entry and entry[0] > monotonic():
+            self._cache.move_to_end(user_id)
+            return entry[1]
+
+        if self.fetch_members:
+            result = await self._fetch_member(user_id)
+        else:
+            result = self._lookup(user_id)
+        if not result:
+            result = await self._fetch_user(user_id)
+        self._store(user_id, result)
+        return result
+
+
+members = MemberResolver(maxsize=settings.member_cache_size, ttl=settings.member_cache_ttl,
+                         fetch_members=settings.low_memory)
+
+
 def gen_color(user_id):
-    random.seed(user_id)
-    c_r = random.randint(0, 255)
-    c_g = random.randint(0, 255)
-    c_b = random.randint(0, 255)
+    # a separate generator gives the same colors as seeding the global one did, without touching it
+    rng = random.Random(user_id)
+    c_r = rng.randint(0, 255)
+    c_g = rng.randint(0, 255)
+    c_b = rng.randint(0, 255)
     return disnake.Color((c_r << 16) + (c_g << 8) + c_b)
 
 
-anti_spam_check = {}
+class Profile(NamedTuple):
+    """What every relay embed shows about a user."""
+    color: disnake.Color
+    name: str
+    avatar_url: str
+
+
+class ProfileCache:
+    """Keeps the embed color, display name and avatar URL of recent users, so relays don't build them every time.
+
+    Entries expire after ``ttl`` seconds like the member cache, since in low memory mode there are no member update
+    events to invalidate them.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # user_id -> (expiry, profile)
+        self._cache = OrderedDict()  # type: OrderedDict[int, Tuple[float, Profile]]
+
+    def invalidate(self, user_id: int):
+        self._cache.pop(user_id, None)
+
+    def clear(self):
+        self._cache.clear()
+
+    def get(self, user: 'Union[disnake.Member, disnake.User]') -> Profile:
+        entry = self._cache.get(user.id)
+        now = monotonic()
+        if entry and entry[0] > now:
+            self._cache.move_to_end(user.id)
+            return entry[1]
+
+        if isinstance(user, disnake.Member) and user.nick:
+            name = f'{user.nick} ({user})'
+        else:
+            name = str(user)
+        avatar_url = user.avatar.url if user.avatar else user.default_avatar.url
+        profile = Profile(gen_color(user.id), name, avatar_url)
+        self._cache[user.id] = (now + self.ttl, profile)
+        self._cache.move_to_end(user.id)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        return profile
+
+
+profiles = ProfileCache(maxsize=settings.member_cache_size, ttl=settings.member_cache_ttl)
+
+
+class SpamLimiter:
+    """Per-user token bucket for the anti-spam auto-ignore.
+
+    Every user may send ``burst`` messages at once, and the bucket refills at ``sustain`` messages per second.
+    Buckets that have refilled completely carry no information, so they are dropped by a periodic sweep.
+    """
+
+    def __init__(self, burst: float, sustain: float):
+        self.burst = burst
+        self.sustain = sustain
+        self._buckets = {}  # type: Dict[int, Tuple[float, float]]
+        self._next_sweep = 0.0
+
+    def _tokens(self, user_id: int, now: float) -> float:
+        try:
+            tokens, updated = self._buckets[user_id]
+        except KeyError:
+            return self.burst
+        return min(self.burst, tokens + (now - updated) * self.sustain)
+
+    def hit(self, user_id: int) -> bool:
+        """Take a token for one message. Returns False if the user went over the limit."""
+        now = monotonic()
+        self._sweep(now)
+        tokens = self._tokens(user_id, now)
+        if tokens < 1:
+            return False
+        self._buckets[user_id] = (tokens - 1, now)
+        return True
+
+    def forget(self, user_id: int):
+        self._buckets.pop(user_id, None)
+
+    def _sweep(self, now: float):
+        if now < self._next_sweep:
+            return
+        # a bucket is full again at most burst / sustain seconds after the last message
+        self._next_sweep = now + self.burst / self.sustain
+        for user_id in [u for u in self._buckets if self._tokens(u, now) >= self.burst]:
+            del self._buckets[user_id]
+
+
+class SpamWindow:
+    """Per-user sliding window for the anti-spam auto-ignore, which is the rule from before token buckets: a user is
+    ignored at their ``messages``-th message within ``seconds`` seconds.
+
+    Windows whose newest message has expired carry no information, so they are dropped by a periodic sweep.
+    """
+
+    def __init__(self, messages: int, seconds: float):
+        self.messages = messages
+        self.seconds = seconds
+        # user_id -> when their recent messages came in, oldest first, never more than messages - 1 of them
+        self._windows = {}  # type: Dict[int, Deque[float]]
+        self._next_sweep = 0.0
+
+    def hit(self, user_id: int) -> bool:
+        """Count one message. Returns False if the user went over the limit."""
+        now = monotonic()
+        self._sweep(now)
+        window = self._windows.setdefault(user_id, deque())
+        while window and window[0] <= now - self.seconds:
+            window.popleft()
+        if len(window) + 1 >= self.messages:
+            return False
+        window.append(now)
+        return True
+
+    def forget(self, user_id: int):
+        self._windows.pop(user_id, None)
+
+    def _sweep(self, now: float):
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self.seconds
+        for user_id in [u for u, w in self._windows.items() if not w or w[-1] <= now - self.seconds]:
+            del self._windows[user_id]
+
+
+def make_anti_spam(new_settings: Settings) -> 'Union[SpamLimiter, SpamWindow]':
+    # a token bucket only comes close to the window, so existing configs without burst or sustain keep the exact rule
+    if new_settings.anti_spam_token_bucket:
+        return SpamLimiter(burst=new_settings.anti_spam_burst, sustain=new_settings.anti_spam_sustain)
+    return SpamWindow(new_settings.anti_spam_messages, new_settings.anti_spam_seconds)
+
+
+anti_spam = make_anti_spam(settings)
+
+
+class ReplyLock:
+    """Stops two replies from going to the same user at once, or within ``cooldown`` seconds of each other.
+
+    Replies to different users never wait on each other.
+    """
+
+    def __init__(self, cooldown: float = 2.0):
+        self.cooldown = cooldown
+        # user_id -> when the lock runs out, infinite while a reply is still being sent
+        self._locked = {}  # type: Dict[int, float]
+        self._next_sweep = 0.0
+
+    def acquire(self, user_id: int) -> bool:
+        now = monotonic()
+        if now >= self._next_sweep:
+            self._next_sweep = now + self.cooldown
+            for expired in [u for u, until in self._locked.items() if until <= now]:
+                del self._locked[expired]
+        if self._locked.get(user_id, 0.0) > now:
+            return False
+        self._locked[user_id] = float('inf')
+        return True
+
+    def release(self, user_id: int):
+        self._locked[user_id] = monotonic() + self.cooldown
+
+
+reply_locks = ReplyLock()
+
+
+async def send_reply(message: disnake.Message, author: disnake.Member, user_id: int, command_contents: str,
+                     keep_source: bool = False) -> bool:
+    """Send a staff reply to a user, then re-post it to the mod-mail channel and delete the original, unless
+    ``keep_source`` is set because the same message goes to other users too. Returns True if it was delivered."""
+    if not reply_locks.acquire(user_id):
+        metrics.inc('modmail_staff_replies_rejected_total')
+        await message.channel.send(f'{author.mention} Your message was not sent to prevent multiple replies '
+                                   f'to the same person within {reply_locks.cooldown:g} seconds.')
+        return False
+    try:
+        with metrics.timer('modmail_staff_reply_seconds'):
+            return await _send_reply(message, author, user_id, command_contents, keep_source)
+    finally:
+        reply_locks.release(user_id)
+
+
+async def _send_reply(message: disnake.Message, author: disnake.Member, user_id: int, command_contents: str,
+                      keep_source: bool) -> bool:
+    channel = message.channel
+    member = await members.resolve(user_id)
+    if not member:
+        await channel.send(f'Failed to find user with ID {user_id}')
+        return False
+
+    if message.attachments and not await check_attachments(channel, message.attachments):
+        return False
+
+    if settings.anonymous_staff:
+        to_send = 'Staff reply: '
+    else:
+        to_send = f'{author.mention}: '
+    to_send += command_contents
+
+    # the staff message is only deleted once the reply is delivered, so a retry can download its attachments again
+    entry_id, deferred = await outbox.add('reply', member.id, {
+        'user_id': member.id, 'author_id': author.id, 'content': to_send, 'contents': command_contents,
+        'channel_id': channel.id, 'source_message_id': message.id, 'keep_source': keep_source})
+    if deferred:
+        await channel.send(f'{author.mention} Earlier replies to {member.id} have not been delivered yet, '
+                           f'this one will be sent after them. Delete your message to cancel it.')
+        return False
+
+    # set once the entry is delivered or handed to the retry loop, if anything else goes wrong it must not be left
+    # for the next start to deliver a reply that staff saw fail
+    settled = False
+    attachments = []
+    try:
+        progress_msg = None
+        if message.attachments:
+            count = len(message.attachments)
+            progress_msg = await channel.send(f'Downloading attachments... 0/{count}')
+            attachments = await download_attachments(message.attachments, progress_msg, spooled=keep_source)
+
+        try:
+            if progress_msg:
+                await progress_msg.edit(content=f'Sending message with {len(attachments)} '
+                                                f'attachments...')
+            try:
+                if attachments:
+                    with metrics.timer('modmail_attachment_upload_seconds'):
+                        staff_msg = await member.send(to_send, files=attachments)
+                else:
+                    staff_msg = await member.send(to_send)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                await outbox.defer(entry_id, member.id)
+                settled = True
+                await channel.send(f'{author.mention} Failed to deliver to {member.id} ({type(e).__name__}), '
+                                   f'it will be retried. Delete your message to cancel it.')
+                return False
+            outbox.done(entry_id)
+            settled = True
+
+            await finish_reply(channel, member, author.id, staff_msg, command_contents)
+            if progress_msg:
+                await progress_msg.delete()
+            if not keep_source:
+                await message.delete()
+            return True
+
+        except disnake.errors.Forbidden:
+            await channel.send(f'{author.mention} {member.mention} has disabled DMs '
+                               f'or is not in a shared server.')
+            return False
+    finally:
+        if not settled:
+            outbox.done(entry_id)
+        for attach in attachments:
+            attach.close()
+
+
+async def finish_reply(channel: disnake.TextChannel, member: 'Union[disnake.Member, disnake.User]', author_id: int,
+                       staff_msg: disnake.Message, command_contents: str):
+    """Log a delivered staff reply and show it in the mod-mail channel it was sent from."""
+    metrics.inc('modmail_staff_replies_total')
+    log_message(member.id, author_id, staff_msg, True, command_contents)
+    embed = disnake.Embed(color=profiles.get(member).color, description=command_contents)
+    header_message = f'<@{author_id}> replying to {member.id} {member.mention}'
+    if await is_ignored(member.id):
+        header_message += ' (replies ignored)'
+
+    # add attachment links to mod-mail message
+    if staff_msg.attachments:
+        attachment_urls = []
+        for attachment in staff_msg.attachments:
+            attachment_urls.append(f'[{attachment.filename}]({attachment.url}) '
+                                   f'({attachment.size} bytes)')
+        attachment_msg = '\N{BULLET} ' + '\n\N{BULLET} '.join(attachment_urls)
+        embed.add_field(name='Attachments', value=attachment_msg, inline=False)
+
+    await channel.send(header_message, embed=embed)
+
+
+class RelayDispatcher:
+    """Sends DM relays to one mod-mail channel in the order they came in.
+
+    Relays that pile up while a message is being sent (usually while a rate limit is waited out) are packed into one
+    message, up to the embed limits of a single message. Reactions on the original DMs go through a separate lane
+    that only runs while no relays are waiting.
+    """
+
+    max_embeds = 10
+    max_embed_chars = 6000
+    # room for the user ID added to the footer of batched embeds
+    footer_chars = 20
+
+    def __init__(self, channel: disnake.TextChannel):
+        self.channel = channel
+        self._relays = deque()  # type: Deque[Tuple[int, disnake.Embed, asyncio.Future]]
+        self._reactions = deque()  # type: Deque[Tuple[disnake.Message, str]]
+        self._wakeup = None  # type: Optional[asyncio.Event]
+        self._task = None  # type: Optional[asyncio.Task]
+
+    def start(self):
+        # created here so they belong to the loop the client is running on
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+    def relay(self, user_id: int, embed: disnake.Embed) -> 'asyncio.Future':
+        """Queue an embed for the mod-mail channel. The future resolves to the message it ended up in."""
+        future = asyncio.get_running_loop().create_future()
+        self._relays.append((user_id, embed, future))
+        self._wakeup.set()
+        return future
+
+    def react(self, message: disnake.Message, emoji: str):
+        self._reactions.append((message, emoji))
+        self._wakeup.set()
+
+    def _take_batch(self) -> 'List[Tuple[int, disnake.Embed, asyncio.Future]]':
+        batch = [self._relays.popleft()]
+        size = len(batch[0][1]) + self.footer_chars
+        while self._relays and len(batch) < self.max_embeds:
+            next_size = len(self._relays[0][1]) + self.footer_chars
+            if size + next_size > self.max_embed_chars:
+                break
+            size += next_size
+            batch.append(self._relays.popleft())
+        return batch
+
+    async def _send_batch(self, batch: 'List[Tuple[int, disnake.Embed, asyncio.Future]]'):
+        if len(batch) > 1:
+            # the IDs are listed in the same order as the embeds, and each embed also gets its own in the footer
+            for user_id, embed, _ in batch:
+                embed.set_footer(text=str(user_id))
+        content = '\n'.join(str(user_id) for user_id, _, _ in batch)
+        metrics.observe('modmail_relay_batch_size', len(batch), buckets=(1, 2, 3, 5, 10))
+        try:
+            with metrics.timer('modmail_relay_send_seconds'):
+                msg = await self.channel.send(content, embeds=[embed for _, embed, _ in batch])
+        except Exception as e:
+            metrics.inc('modmail_relay_send_errors_total')
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_result(msg)
+
+    async def _run(self):
+        while True:
+            if self._relays:
+                await self._send_batch(self._take_batch())
+            elif self._reactions:
+                message, emoji = self._reactions.popleft()
+                try:
+                    await message.add_reaction(emoji)
+                except disnake.HTTPException as e:
+                    print(f'Failed to add reaction to message {message.id}: {type(e).__name__} {e}')
+            else:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+
+
+class ModmailChannel:
+    """A mod-mail channel and what is tracked separately for each one: its relay queue, the last user whose DM was
+    relayed to it (for ?m and ?r), and its typing indicator."""
+
+    def __init__(self, channel: disnake.TextChannel):
+        self.channel = channel
+        self.relays = RelayDispatcher(channel)
+        self.last_id = 'uninitialized'  # type: Union[int, str]
+        # when the current typing indicator runs out
+        self.typing_until = 0.0
+
+
+# channel ID -> state, for every channel in settings.channel_ids and settings.guild_channels
+client.modmail_channels = {}  # type: Dict[int, ModmailChannel]
+metrics.gauge('modmail_relay_queue_depth',
+              lambda: sum(len(c.relays._relays) for c in client.modmail_channels.values()))
+metrics.gauge('modmail_reaction_queue_depth',
+              lambda: sum(len(c.relays._reactions) for c in client.modmail_channels.values()))
+
+
+def set_channels(new_settings: Settings) -> 'List[int]':
+    """Look up every mod-mail channel in the settings, starting relay queues for new ones. Returns the IDs that
+    were not found, in which case nothing is changed."""
+    channel_ids = list(new_settings.channel_ids) + list(new_settings.guild_channels.values())
+    channels = {channel_id: client.get_channel(channel_id) for channel_id in channel_ids}
+    missing = [channel_id for channel_id, channel in channels.items() if not channel]
+    if missing:
+        return missing
+
+    modmail_channels = {}
+    for channel_id, channel in channels.items():
+        modmail_channel = client.modmail_channels.get(channel_id)
+        if not modmail_channel:
+            modmail_channel = ModmailChannel(channel)
+            modmail_channel.relays.start()
+        else:
+            # after reconnecting the channel is a new object
+            modmail_channel.channel = modmail_channel.relays.channel = channel
+        modmail_channels[channel_id] = modmail_channel
+    # channels that were removed keep their task, so anything already queued still goes out
+    client.modmail_channels = modmail_channels
+    client.channel = channels[new_settings.channel_id]
+    return []
+
+
+def route(user: 'Union[disnake.Member, disnake.User]') -> ModmailChannel:
+    """Pick the mod-mail channel for a user: the one for a guild they share with the bot if there is one, otherwise
+    one of the general channels picked by user ID, so a user always ends up in the same channel."""
+    if settings.guild_channels:
+        if isinstance(user, disnake.Member) and user.guild.id in settings.guild_channels:
+            return client.modmail_channels[settings.guild_channels[user.guild.id]]
+        for guild_id, channel_id in settings.guild_channels.items():
+            guild = client.get_guild(guild_id)
+            if guild and guild.get_member(user.id):
+                return client.modmail_channels[channel_id]
+    # Fibonacci hashing, since the low bits of an ID are a per-process counter that is usually 0
+    channel_ids = settings.channel_ids
+    user_hash = (user.id * 0x9E3779B97F4A7C15 & 0xFFFFFFFFFFFFFFFF) >> 32
+    return client.modmail_channels[channel_ids[user_hash % len(channel_ids)]]
+
+
+def is_retryable(e: Exception) -> bool:
+    """Whether sending may work if tried again later, as opposed to something like missing permissions."""
+    if isinstance(e, disnake.HTTPException):
+        return e.status >= 500 or e.status == 429
+    return isinstance(e, (asyncio.TimeoutError, aiohttp.ClientError, OSError))
+
+
+class Outbox:
+    """Keeps relays and staff replies in the database until Discord confirms them.
+
+    The first attempt is made right away by the handler. If it fails in a way that may work later, the entry is
+    deferred and retried here with exponential backoff. Entries are retried in order per recipient, and while a
+    recipient has deferred entries, new ones for it are queued behind them instead of being sent right away.
+
+    An entry that was being sent when the bot stopped is retried on the next start, so delivery is at least once.
+    """
+
+    base_backoff = 5.0
+    max_backoff = 600.0
+
+    def __init__(self):
+        # kind -> coroutine function that sends a payload of that kind
+        self.senders = {}  # type: Dict[str, Callable[[dict], Awaitable[None]]]
+        # recipients that have deferred entries, filled in from the database by prepare()
+        self.blocked = set()  # type: Set[int]
+        self._deferred_during_pass = set()  # type: Set[int]
+        self._wakeup = None  # type: Optional[asyncio.Event]
+        self._task = None  # type: Optional[asyncio.Task]
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+    def wake(self):
+        if self._wakeup:
+            self._wakeup.set()
+
+    def backoff(self, attempts: int) -> float:
+        return min(self.base_backoff * 2 ** attempts, self.max_backoff)
+
+    async def add(self, kind: str, recipient: int, payload: dict) -> 'Tuple[int, bool]':
+        """Store an entry before its first attempt. Returns its ID, and True if it was queued behind deferred ones
+        for the same recipient, in which case the caller must not send it."""
+        deferred = recipient in self.blocked
+        entry_id = await database.write(_insert_outbox, kind, recipient, json.dumps(payload), deferred, time())
+        if deferred:
+            metrics.inc('modmail_outbox_deferred_total')
+            self.wake()
+        return entry_id, deferred
+
+    def done(self, entry_id: int):
+        database.write(_delete_outbox, entry_id).add_done_callback(_report_write_failure)
+
+    async def defer(self, entry_id: int, recipient: int):
+        """Hand an entry whose first attempt failed over to the retry loop."""
+        await database.write(_defer_outbox, entry_id, time() + self.backoff(0))
+        self.blocked.add(recipient)
+        self._deferred_during_pass.add(recipient)
+        metrics.inc('modmail_outbox_deferred_total')
+        self.wake()
+
+    async def _drain(self) -> 'Optional[float]':
+        """Try every entry that is due. Returns when the next one will be due, if any are left."""
+        next_due = None
+        waiting = set()
+        for entry_id, kind, recipient, payload, attempts, next_attempt in await database.read(_select_outbox):
+            # a recipient that is still waiting doesn't get anything newer either
+            if recipient in waiting:
+                continue
+            if next_attempt > time():
+                waiting.add(recipient)
+                next_due = min(next_due or next_attempt, next_attempt)
+                continue
 
-anti_duplicate_replies = {}
+            try:
+                await self.senders[kind](json.loads(payload))
+            except Exception as e:
+                if is_retryable(e):
+                    metrics.inc('modmail_outbox_retries_total')
+                    next_attempt = time() + self.backoff(attempts)
+                    await database.write(_defer_outbox, entry_id, next_attempt)
+                    waiting.add(recipient)
+                    next_due = min(next_due or next_attempt, next_attempt)
+                    continue
+                print(f'Dropping queued {kind} for {recipient}: {type(e).__name__} {e}')
+                try:
+                    await client.channel.send(f'Gave up on a queued {kind} for {recipient}: {type(e).__name__} {e}')
+                except disnake.HTTPException:
+                    pass
+            await database.write(_delete_outbox, entry_id)
+        return next_due
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            self._deferred_during_pass.clear()
+            try:
+                next_due = await self._drain()
+                self.blocked = set(await database.read(_select_deferred_recipients)) | self._deferred_during_pass
+            except Exception as e:
+                print(f'Outbox retry loop failed: {type(e).__name__} {e}')
+                next_due = time() + self.base_backoff
+
+            timeout = None if next_due is None else max(0.0, next_due - time())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+outbox = Outbox()
+metrics.gauge('modmail_outbox_blocked_recipients', lambda: len(outbox.blocked))
+
+
+async def retry_relay(payload: dict):
+    # the channel may have been removed from the config since
+    modmail_channel = client.modmail_channels.get(payload.get('modmail_channel_id')) or route(
+        await members.resolve(payload['user_id']) or disnake.Object(payload['user_id']))
+    await modmail_channel.relays.relay(payload['user_id'], disnake.Embed.from_dict(payload['embed']))
+    dm_channel = client.get_partial_messageable(payload['channel_id'], type=disnake.ChannelType.private)
+    modmail_channel.relays.react(dm_channel.get_partial_message(payload['message_id']), '\N{WHITE HEAVY CHECK MARK}')
+
+
+async def retry_reply(payload: dict):
+    try:
+        channel = client.get_channel(payload['channel_id']) or client.channel
+        message = await channel.fetch_message(payload['source_message_id'])
+    except disnake.NotFound:
+        # staff deleted their message, which cancels the reply
+        return
+    member = await members.resolve(payload['user_id'])
+    if not member:
+        raise LookupError(f'user {payload["user_id"]} not found')
+
+    # the message of a reply to several users is kept for the others, and its attachments may be spooled already
+    keep_source = payload.get('keep_source', False)
+    attachments = await download_attachments(message.attachments, spooled=keep_source) if message.attachments else []
+    try:
+        staff_msg = await member.send(payload['content'], files=attachments)
+    finally:
+        for attach in attachments:
+            attach.close()
+    # delivered now, so nothing after this may make the outbox retry it or report it as given up
+    try:
+        await finish_reply(message.channel, member, payload['author_id'], staff_msg, payload['contents'])
+        if not keep_source:
+            await message.delete()
+    except Exception as e:
+        print(f'Delivered a queued reply to {member.id} but failed to finish it: {type(e).__name__} {e}')
+
+
+outbox.senders['relay'] = retry_relay
+outbox.senders['reply'] = retry_reply
+
+
+# a typing indicator lasts about 10 seconds, so one trigger per window covers everyone typing at the same time
+typing_window = 10.0
 
 
 @client.event
 async def on_typing(channel, user, when):
+    metrics.inc('modmail_typing_events_total')
+    if not client.already_ready:
+        return
+    # checked first because it is the cheapest way to drop an event
+    if user.id in ignored_users:
+        return
     if isinstance(channel, disnake.DMChannel):
-        if not is_ignored(user.id):
-            await client.channel.trigger_typing()
+        # routing by ID alone needs nothing else, and typing must never spend API calls that relays need
+        modmail_channel = route(members.cached(user.id) or user if settings.guild_channels else user)
+        now = monotonic()
+        if now < modmail_channel.typing_until:
+            return
+        # set before the request so events arriving while it is in flight are dropped too
+        modmail_channel.typing_until = now + typing_window
+        metrics.inc('modmail_typing_triggers_total')
+        with metrics.timer('modmail_typing_trigger_seconds'):
+            await modmail_channel.channel.trigger_typing()
+
+
+@client.event
+async def on_resumed():
+    outbox.wake()
+
+
+@client.event
+async def on_member_join(member):
+    members.invalidate(member.id)
+    profiles.invalidate(member.id)
+
+
+@client.event
+async def on_member_update(before, after):
+    members.invalidate(after.id)
+    profiles.invalidate(after.id)
+
+
+@client.event
+async def on_member_remove(member):
+    members.invalidate(member.id)
+    profiles.invalidate(member.id)
+
+
+@client.event
+async def on_user_update(before, after):
+    members.invalidate(after.id)
+    profiles.invalidate(after.id)
+
+
+# command name -> handler, anything else that is a number is a user ID to reply to
+commands = {}  # type: Dict[str, Callable[[disnake.Message, str, str], Awaitable[None]]]
+
+
+def command(*names: str):
+    def decorator(func):
+        for name in names:
+            commands[name] = func
+        return func
+    return decorator
+
+
+def parse_user_ids(command_contents: str) -> 'Tuple[List[int], Optional[str]]':
+    """Split ``<id> [<id> ...] [reason]`` into the IDs and the reason. IDs can be separated by spaces, commas or
+    new lines. After the first one, only numbers long enough to be user IDs are taken, so a reason can still start
+    with a number. Raises ValueError if the first one is not a number."""
+    user_ids = []
+    rest = command_contents.strip()
+    while rest:
+        token, rest = (rest.split(maxsplit=1) + [''])[:2]
+        parts = [x for x in token.split(',') if x]
+        if user_ids and not all(x.isdigit() and len(x) >= 15 for x in parts):
+            rest = f'{token} {rest}'.strip()
+            break
+        user_ids += [int(x) for x in parts]
+    if not user_ids and command_contents.strip():
+        raise ValueError('no user IDs')
+    return user_ids, rest or None
+
+
+def parse_ignore_file(filename: str, data: bytes, is_quiet: bool,
+                      reason: 'Optional[str]') -> 'List[Tuple[int, bool, Optional[str]]]':
+    """Read user IDs from a JSON or CSV file, like the ones ?exportignored makes. JSON can also be a plain list of
+    IDs, like ignored.json. CSV needs a user_id column, or the ID in the first column if there is no header. Rows
+    without quiet or reason use the ones from the command. Raises ValueError if the file can't be read."""
+    rows = []
+    text = data.decode('utf-8-sig')
+    if filename.lower().endswith('.json'):
+        for entry in json.loads(text):
+            if isinstance(entry, dict):
+                rows.append((int(entry['user_id']), bool(entry.get('quiet', is_quiet)), entry.get('reason', reason)))
+            else:
+                rows.append((int(entry), is_quiet, reason))
+        return rows
+
+    reader = csv.reader(StringIO(text))
+    columns = {'user_id': 0}
+    for line in reader:
+        if not line or not line[0].strip():
+            continue
+        if not rows and not line[0].strip().isdigit():
+            columns = {name.strip().lower(): i for i, name in enumerate(line)}
+            if 'user_id' not in columns:
+                raise ValueError('no user_id column')
+            continue
+        row_quiet = is_quiet
+        row_reason = reason
+        if 'quiet' in columns and len(line) > columns['quiet'] and line[columns['quiet']].strip():
+            row_quiet = line[columns['quiet']].strip().lower() in {'1', 'true', 'yes'}
+        if 'reason' in columns and len(line) > columns['reason'] and line[columns['reason']]:
+            row_reason = line[columns['reason']]
+        rows.append((int(line[columns['user_id']]), row_quiet, row_reason))
+    return rows
+
+
+async def read_ignore_files(message: disnake.Message, is_quiet: bool,
+                            reason: 'Optional[str]') -> 'Optional[List[Tuple[int, bool, Optional[str]]]]':
+    """Read every file attached to a bulk ignore command. Reports the problem and returns None if one can't be
+    used."""
+    rows = []
+    for a in message.attachments:
+        # checked from the metadata, before anything is downloaded
+        if a.size > attachment_size_limit:
+            await message.channel.send(f'`{disnake.utils.escape_markdown(a.filename)}` is too large, the limit is '
+                                       f'{attachment_size_limit} bytes.')
+            return None
+        try:
+            rows += parse_ignore_file(a.filename, await a.read(), is_quiet, reason)
+        except (ValueError, KeyError, TypeError) as e:
+            await message.channel.send(f'Could not read `{disnake.utils.escape_markdown(a.filename)}`: '
+                                       f'{type(e).__name__} {e}')
+            return None
+    return rows
+
+
+@command('ignore', 'qignore')
+async def cmd_ignore(message: disnake.Message, command_name: str, command_contents: str):
+    author = message.author
+    if not (command_contents or message.attachments):
+        await message.channel.send('Did you forget to enter an ID?')
+        return
+    try:
+        user_ids, reason = parse_user_ids(command_contents)
+    except ValueError:
+        await message.channel.send('Could not convert to int.')
+        return
+    is_quiet = command_name == 'qignore'
+
+    if message.attachments or len(user_ids) > 1:
+        rows = [(user_id, is_quiet, reason) for user_id in user_ids]
+        file_rows = await read_ignore_files(message, is_quiet, reason)
+        if file_rows is None:
+            return
+        # the last row for an ID wins
+        rows = list({row[0]: row for row in rows + file_rows}.values())
+        count = await add_ignores(rows)
+        await message.channel.send(
+            f'{author.mention} {count} users are now ignored, {len(rows) - count} were already ignored. '
+            f'Nobody is notified of a bulk ignore. Use `{settings.command_prefix}unignore` to reverse.')
+        return
+
+    user_id = user_ids[0]
+    if await add_ignore(user_id, reason, is_quiet):
+        if not is_quiet:
+            to_send = 'Your messages are being ignored by staff.'
+            if reason:
+                to_send += ' Reason: ' + reason
+            member = await members.resolve(user_id)
+            if member:
+                try:
+                    await member.send(to_send)
+                except disnake.errors.Forbidden:
+                    await message.channel.send(f'{member.mention} has disabled DMs or is not in a '
+                                               f'shared server, not sending reason.')
+            else:
+                await message.channel.send('Failed to find user with ID, not sending reason.')
+        await message.channel.send(
+            f'{author.mention} {user_id} is now ignored. Messages from this user will not appear. '
+            f'Use `{settings.command_prefix}unignore` to reverse.')
+    else:
+        await message.channel.send(f'{author.mention} {user_id} is already ignored.')
+
+
+@command('unignore')
+async def cmd_unignore(message: disnake.Message, command_name: str, command_contents: str):
+    author = message.author
+    if not (command_contents or message.attachments):
+        await message.channel.send('Did you forget to enter an ID?')
+        return
+    try:
+        user_ids, _ = parse_user_ids(command_contents)
+    except ValueError:
+        await message.channel.send('Could not convert to int.')
+        return
+
+    if message.attachments or len(user_ids) > 1:
+        file_rows = await read_ignore_files(message, False, None)
+        if file_rows is None:
+            return
+        user_ids = list(dict.fromkeys(user_ids + [row[0] for row in file_rows]))
+        count = await remove_ignores(user_ids)
+        await message.channel.send(
+            f'{author.mention} {count} users are no longer ignored, {len(user_ids) - count} were not ignored. '
+            f'Nobody is notified of a bulk unignore.')
+        return
+
+    user_id = user_ids[0]
+    ignored = await is_ignored(user_id)
+    if ignored:
+        is_quiet = ignored[0]
+        if not is_quiet:
+            to_send = 'Your messages are no longer being ignored by staff.'
+            member = await members.resolve(user_id)
+            if member:
+                try:
+                    await member.send(to_send)
+                except disnake.errors.Forbidden:
+                    await message.channel.send(f'{member.mention} has disabled DMs or is not in '
+                                               f'a shared server, not sending notification.')
+            else:
+                await message.channel.send('Failed to find user with ID, not sending notification.')
+    if await remove_ignore(user_id):
+        await message.channel.send(
+            f'{author.mention} {user_id} is no longer ignored. Messages from this user will appear '
+            f'again. Use `{settings.command_prefix}ignore` to reverse.')
+    else:
+        await message.channel.send(f'{author.mention} {user_id} is not ignored.')
+
+
+@command('reloadignored')
+async def cmd_reloadignored(message: disnake.Message, command_name: str, command_contents: str):
+    count = await load_ignored()
+    await message.channel.send(f'Reloaded ignore list from the database, {count} users are ignored.')
+
+
+@command('exportignored')
+async def cmd_exportignored(message: disnake.Message, command_name: str, command_contents: str):
+    fmt = command_contents.strip().lower() or 'csv'
+    if fmt not in {'csv', 'json'}:
+        await message.channel.send('The format can be `csv` or `json`.')
+        return
+    # written straight from the database cursor, so a big list never has to fit in memory
+    with TemporaryFile() as fp:
+        count = await database.read(_export_ignored, fp, fmt)
+        size = fp.tell()
+        if size > attachment_size_limit:
+            await message.channel.send(f'The export is {size} bytes, which is too large to upload.')
+            return
+        fp.seek(0)
+        await message.channel.send(f'{count} users are ignored.', file=disnake.File(fp, f'ignored.{fmt}'))
+
+
+@command('reload')
+async def cmd_reload(message: disnake.Message, command_name: str, command_contents: str):
+    global settings, anti_spam
+    try:
+        new_settings = load_settings()
+    except ValueError as e:
+        await message.channel.send(f'Config was not reloaded: {e}')
+        return
+    missing = set_channels(new_settings)
+    if missing:
+        await message.channel.send(f'Config was not reloaded: channels with IDs {", ".join(map(str, missing))} '
+                                   f'not found.')
+        return
+
+    old_settings = settings
+    settings = new_settings
+    members.maxsize = settings.member_cache_size
+    members.ttl = settings.member_cache_ttl
+    profiles.maxsize = settings.member_cache_size
+    profiles.ttl = settings.member_cache_ttl
+    spool.max_size = settings.attachment_spool_size
+    # the counts start over, like they do on a restart
+    anti_spam = make_anti_spam(settings)
+    if settings.playing != old_settings.playing:
+        await client.change_presence(activity=disnake.Game(name=settings.playing))
+
+    to_send = 'Config reloaded.'
+    if (settings.token, settings.low_memory, settings.sharded, settings.shard_count) != (
+            old_settings.token, old_settings.low_memory, old_settings.sharded, old_settings.shard_count):
+        to_send += ' Changes to token, low_memory, sharded and shard_count need a restart.'
+    await message.channel.send(to_send)
+
+
+@command('history')
+async def cmd_history(message: disnake.Message, command_name: str, command_contents: str):
+    command_args = command_contents.split()
+    if not command_args:
+        await message.channel.send('Did you forget to enter an ID?')
+        return
+    page = 1
+    cursor = None
+    try:
+        user_id = int(command_args[0])
+        if len(command_args) > 1:
+            if command_args[1].startswith('before:'):
+                # from the "Next page" hint, the timestamp and ID of the last message already shown
+                timestamp, message_id = command_args[1][len('before:'):].split('.')
+                cursor = (int(timestamp), int(message_id))
+            else:
+                page = int(command_args[1])
+    except ValueError:
+        await message.channel.send('Could not convert to int.')
+        return
+    if page < 1:
+        await message.channel.send('Pages start at 1.')
+        return
+
+    rows = await get_history(user_id, page, cursor)
+    if not rows:
+        await message.channel.send(f'No messages on this page of the history for {user_id}.')
+        return
+
+    if cursor:
+        lines = [f'History for {user_id}, before <t:{cursor[0] // 1000}:f> (newest first):']
+    else:
+        lines = [f'History for {user_id}, page {page} (newest first):']
+    for _, timestamp, author_id, from_staff, content, attachments in rows:
+        who = f'staff {author_id}' if from_staff else 'user'
+        # short enough that a full page fits in one message
+        if len(content) > 100:
+            content = content[:100] + '...'
+        line = f'<t:{timestamp // 1000}:f> **{who}**: {disnake.utils.escape_mentions(content)}'
+        if attachments:
+            line += f' ({attachments.count(chr(10)) + 1} attachments)'
+        lines.append(line)
+    if len(rows) == history_page_size:
+        # a cursor instead of a page number, so messages logged in the meantime don't shift what comes next
+        lines.append(f'Next page: `{settings.command_prefix}history {user_id} before:{rows[-1][1]}.{rows[-1][0]}`')
+    await message.channel.send('\n'.join(lines))
+
+
+@command('stats')
+async def cmd_stats(message: disnake.Message, command_name: str, command_contents: str):
+    summary = metrics.render_summary() or 'Nothing recorded yet.'
+    # keep it inside one message, the full set is available from the metrics endpoint
+    if len(summary) > 1900:
+        summary = summary[:1900].rsplit('\n', 1)[0] + '\n...'
+    await message.channel.send(f'```\n{summary}\n```')
+
+
+@command('fixgame')
+async def cmd_fixgame(message: disnake.Message, command_name: str, command_contents: str):
+    await client.change_presence(activity=None)
+    await client.change_presence(activity=disnake.Game(name=settings.playing))
+    await message.channel.send('Game presence re-set.')
+
+
+@command('m')
+async def cmd_m(message: disnake.Message, command_name: str, command_contents: str):
+    last_id = client.modmail_channels[message.channel.id].last_id
+    await message.channel.send(f'{last_id} <@!{last_id}>')
+
+
+@command('r')
+async def cmd_r(message: disnake.Message, command_name: str, command_contents: str):
+    last_id = client.modmail_channels[message.channel.id].last_id
+    if not isinstance(last_id, int):
+        await message.channel.send(f'Failed to find user with ID {last_id}')
+        return
+    await reply_command(message, last_id, command_contents)
+
+
+async def reply_command(message: disnake.Message, user_id: int, command_contents: str):
+    """Shared by ?r and ?<userid>."""
+    if not (command_contents or message.attachments):
+        await message.channel.send('Did you forget to enter a message?')
+        return
+    await send_reply(message, message.author, user_id, command_contents)
+
+
+async def reply_many(message: disnake.Message, user_ids: 'List[int]', command_contents: str):
+    """Send the same reply to several users with ?<userid>,<userid>,... Attachments are downloaded once into the
+    spool and uploaded to each user from there. The staff message is only deleted once every reply is delivered."""
+    if not (command_contents or message.attachments):
+        await message.channel.send('Did you forget to enter a message?')
+        return
+    if message.attachments and not await check_attachments(message.channel, message.attachments):
+        return
+    delivered = 0
+    for user_id in user_ids:
+        delivered += await send_reply(message, message.author, user_id, command_contents, keep_source=True)
+    if delivered == len(user_ids):
+        await message.delete()
+    else:
+        await message.channel.send(f'{message.author.mention} Delivered to {delivered} of {len(user_ids)} users, '
+                                   f'your message is kept for the others.')
 
 
 @client.event
@@ -155,35 +2118,32 @@ async def on_message(message):
     if not client.already_ready:
         return
 
-    if type(message.channel) is disnake.DMChannel:
-        if is_ignored(author.id):
+    if isinstance(message.channel, disnake.DMChannel):
+        start = perf_counter()
+        metrics.inc('modmail_dm_received_total')
+        if await is_ignored(author.id):
+            metrics.inc('modmail_dm_ignored_total')
             return
-        if author.id not in anti_spam_check:
-            anti_spam_check[author.id] = 0
-
-        anti_spam_check[author.id] += 1
-        if anti_spam_check[author.id] >= int(config['AntiSpam']['messages']):
-            add_ignore(author.id, 'Automatic anti-spam ignore')
-            await client.channel.send(
-                f'{author.id} {author.mention} auto-ignored due to spam. '
-                f'Use `{config["Main"]["command_prefix"]}unignore` to reverse.')
+        if not anti_spam.hit(author.id):
+            metrics.inc('modmail_dm_spam_total')
+            # more messages from this user can come in while this is being added, only report it once
+            if await add_ignore(author.id, 'Automatic anti-spam ignore'):
+                await route(author).channel.send(
+                    f'{author.id} {author.mention} auto-ignored due to spam. '
+                    f'Use `{settings.command_prefix}unignore` to reverse.')
+            anti_spam.forget(author.id)
             return
 
-        # for the purpose of nicknames, if anys
-        for server in client.guilds:
-            member = server.get_member(author.id)
-            if member:
-                author = member
-            break
+        # for the purpose of nicknames, if any, so a failed lookup (like during an outage) mustn't lose the DM
+        try:
+            author = await members.resolve(author.id) or author
+        except Exception as e:
+            print(f'Failed to look up {author.id}, relaying without a nickname: {type(e).__name__} {e}')
 
-        embed = disnake.Embed(color=gen_color(int(author.id)), description=message.content)
-        if isinstance(author, disnake.Member) and author.nick:
-            author_name = f'{author.nick} ({author})'
-        else:
-            author_name = str(author)
-        embed.set_author(name=author_name, icon_url=author.avatar.url if author.avatar else author.default_avatar.url)
+        profile = profiles.get(author)
+        embed = disnake.Embed(color=profile.color, description=message.content)
+        embed.set_author(name=profile.name, icon_url=profile.avatar_url)
 
-        to_send = f'{author.id}'
         if message.attachments:
             attachment_urls = []
             for attachment in message.attachments:
@@ -191,297 +2151,53 @@ async def on_message(message):
                                        f'({attachment.size} bytes)')
             attachment_msg = '\N{BULLET} ' + '\n\N{BULLET} '.join(attachment_urls)
             embed.add_field(name='Attachments', value=attachment_msg, inline=False)
-        await client.channel.send(to_send, embed=embed)
-        await message.add_reaction('\N{WHITE HEAVY CHECK MARK}')
-        client.last_id = author.id
-        await asyncio.sleep(int(config['AntiSpam']['seconds']))
-        anti_spam_check[author.id] -= 1
-
-    elif message.channel == client.channel:
-        if message.content.startswith(config['Main']['command_prefix']):
-            # this might be the wrong way
-            command_split = message.content[len(config['Main']['command_prefix']):].strip().split(maxsplit=1)
+        modmail_channel = route(author)
+        # each channel is its own outbox recipient, so a channel that is failing doesn't hold up the others
+        entry_id, deferred = await outbox.add('relay', modmail_channel.channel.id, {
+            'user_id': author.id, 'embed': embed.to_dict(), 'modmail_channel_id': modmail_channel.channel.id,
+            'channel_id': message.channel.id, 'message_id': message.id})
+        log_message(author.id, author.id, message, False, message.content)
+        modmail_channel.last_id = author.id
+        if deferred:
+            return
+
+        try:
+            await modmail_channel.relays.relay(author.id, embed)
+        except Exception as e:
+            if not is_retryable(e):
+                outbox.done(entry_id)
+                raise
+            await outbox.defer(entry_id, modmail_channel.channel.id)
+            return
+        outbox.done(entry_id)
+        metrics.observe('modmail_dm_relay_seconds', perf_counter() - start)
+        modmail_channel.relays.react(message, '\N{WHITE HEAVY CHECK MARK}')
+
+    elif message.channel.id in client.modmail_channels:
+        prefix = settings.command_prefix
+        if message.content.startswith(prefix):
+            command_split = message.content[len(prefix):].strip().split(maxsplit=1)
+            if not command_split:
+                return
             command_name = command_split[0]
             try:
                 command_contents = command_split[1]
             except IndexError:
                 command_contents = ''
 
-            if command_name == 'ignore' or command_name == 'qignore':
-                if not command_contents:
-                    await client.channel.send('Did you forget to enter an ID?')
-                else:
-                    try:
-                        command_args = command_contents.split(' ', maxsplit=1)
-                        user_id = int(command_args[0])
-                        try:
-                            reason = command_args[1]
-                        except IndexError:
-                            reason = None
-                    except ValueError:
-                        await client.channel.send('Could not convert to int.')
-                        return
-                    is_quiet = command_name == 'qignore'
-                    if add_ignore(user_id, reason, is_quiet):
-                        if not is_quiet:
-                            to_send = 'Your messages are being ignored by staff.'
-                            if reason:
-                                to_send += ' Reason: ' + reason
-                            for server in client.guilds:
-                                member = server.get_member(user_id)
-                                if member:
-                                    try:
-                                        await member.send(to_send)
-                                    except disnake.errors.Forbidden:
-                                        await client.channel.send(f'{member.mention} has disabled DMs or is not in a '
-                                                                  f'shared server, not sending reason.')
-                                    break
-                            else:
-                                await client.channel.send('Failed to find user with ID, not sending reason.')
-                        await client.channel.send(
-                            f'{author.mention} {user_id} is now ignored. Messages from this user will not appear. '
-                            f'Use `{config["Main"]["command_prefix"]}unignore` to reverse.')
-                    else:
-                        await client.channel.send(f'{author.mention} {user_id} is already ignored.')
-
-            elif command_name == 'unignore':
-                if not command_contents:
-                    await client.channel.send('Did you forget to enter an ID?')
-                else:
-                    try:
-                        user_id = int(command_contents.split(' ', maxsplit=1)[0])
-                    except ValueError:
-                        await client.channel.send('Could not convert to int.')
-                        return
-                    ignored = is_ignored(user_id)
-                    if ignored:
-                        is_quiet = ignored[0]
-                        if not is_quiet:
-                            to_send = 'Your messages are no longer being ignored by staff.'
-                            for server in client.guilds:
-                                member = server.get_member(user_id)
-                                if member:
-                                    try:
-                                        await member.send(to_send)
-                                    except disnake.errors.Forbidden:
-                                        await client.channel.send(f'{member.mention} has disabled DMs or is not in '
-                                                                  f'a shared server, not sending notification.')
-                                    break
-                            else:
-                                await client.channel.send('Failed to find user with ID, not sending notification.')
-                    if remove_ignore(user_id):
-                        await client.channel.send(
-                            f'{author.mention} {user_id} is no longer ignored. Messages from this user will appear '
-                            f'again. Use `{config["Main"]["command_prefix"]}ignore` to reverse.')
-                    else:
-                        await client.channel.send(f'{author.mention} {user_id} is not ignored.')
-
-            elif command_name == 'fixgame':
-                await client.change_presence(activity=None)
-                await client.change_presence(activity=disnake.Game(name=config['Main']['playing']))
-                await client.channel.send('Game presence re-set.')
-
-            elif command_name == 'm':
-                await client.channel.send(f'{client.last_id} <@!{client.last_id}>')
-            
-            elif command_name == 'r':
-                if command_name not in anti_duplicate_replies:
-                    anti_duplicate_replies[command_name] = False
-                elif anti_duplicate_replies[command_name]:
-                    await client.channel.send(
-                                              f'{author.mention} Your message was not sent to prevent multiple replies '
-                                              f'to the same person within 2 seconds.')
-                    return
-                anti_duplicate_replies[command_name] = True
-                if not (command_contents or message.attachments):
-                    await client.channel.send('Did you forget to enter a message?')
-                else:
-                    for server in client.guilds:
-                        member = server.get_member(client.last_id)
-                        if member:
-                            attachments = []
-                            try:
-                                progress_msg = None
-                                if message.attachments:
-                                    size_limit = 0x800000
-                                    size_diff = 0x800
-
-                                    # first check the size of all attachments
-                                    # the 0x800 number is arbitrary, just in case
-                                    # in reality, the file size needs to be like 0x200 smaller than the supposed limit
-                                    error_messages = []
-                                    warning_messages = []
-                                    for a in message.attachments:
-                                        if a.size > size_limit:
-                                            error_messages.append(f'`{disnake.utils.escape_markdown(a.filename)}` '
-                                                                  f'is too large to send in a direct message.')
-                                        elif a.size > size_limit - 0x1000:
-                                            warning_messages.append(f'`{disnake.utils.escape_markdown(a.filename)}` '
-                                                                    f'is very close to the file size limit of the '
-                                                                    f'destination. It may fail to send.')
-
-                                    if error_messages:
-                                        final = '\n'.join(error_messages)
-                                        final += f'\nLimit: {size_limit} bytes ({size_limit / (1024 * 1024):.02f} MiB)'
-                                        final += f'\nRecommended Maximum: {size_limit - size_diff} bytes ' \
-                                                 f'({(size_limit - size_diff) / (1024 * 1024):.02f} MiB)'
-                                        await client.channel.send(final)
-                                        break
-
-                                    if warning_messages:
-                                        final = '\n'.join(warning_messages)
-                                        final += f'\nLimit: {size_limit} bytes ({size_limit / (1024 * 1024):.02f} MiB)'
-                                        final += f'\nRecommended Maximum: {size_limit - size_diff} bytes ' \
-                                                 f'({(size_limit - size_diff) / (1024 * 1024):.02f} MiB)'
-                                        await client.channel.send(final)
-
-                                    count = len(message.attachments)
-                                    progress_msg = await client.channel.send(f'Downloading attachments... 0/{count}')
-                                    for idx, a in enumerate(message.attachments, 1):
-                                        tf = TemporaryFile()
-                                        await a.save(tf, seek_begin=True)
-                                        attachments.append(disnake.File(tf, a.filename))
-                                        await progress_msg.edit(content=f'Downloading attachments... {idx}/{count}')
-
-                                embed = disnake.Embed(color=gen_color(int(client.last_id)), description=command_contents)
-                                if config['Main'].getboolean('anonymous_staff'):
-                                    to_send = 'Staff reply: '
-                                else:
-                                    to_send = f'{author.mention}: '
-                                to_send += command_contents
-                                try:
-                                    if progress_msg:
-                                        await progress_msg.edit(content=f'Sending message with {len(attachments)} '
-                                                                        f'attachments...')
-                                    staff_msg = await member.send(to_send, files=attachments)
-                                    header_message = f'{author.mention} replying to {member.id} {member.mention}'
-                                    if is_ignored(member.id):
-                                        header_message += ' (replies ignored)'
-
-                                    # add attachment links to mod-mail message
-                                    if staff_msg.attachments:
-                                        attachment_urls = []
-                                        for attachment in staff_msg.attachments:
-                                            attachment_urls.append(f'[{attachment.filename}]({attachment.url}) '
-                                                                   f'({attachment.size} bytes)')
-                                        attachment_msg = '\N{BULLET} ' + '\n\N{BULLET} '.join(attachment_urls)
-                                        embed.add_field(name='Attachments', value=attachment_msg, inline=False)
-
-                                    await client.channel.send(header_message, embed=embed)
-                                    if progress_msg:
-                                        await progress_msg.delete()
-                                    await message.delete()
-
-                                except disnake.errors.Forbidden:
-                                    await client.channel.send(f'{author.mention} {member.mention} has disabled DMs '
-                                                              f'or is not in a shared server.')
-                                break
-                            finally:
-                                for attach in attachments:
-                                    attach.close()
-                    else:
-                        await client.channel.send(f'Failed to find user with ID {client.last_id}')
-                await asyncio.sleep(2)
-                anti_duplicate_replies[command_name] = False
-
-            else:
-                if command_name not in anti_duplicate_replies:
-                    anti_duplicate_replies[command_name] = False
-                elif anti_duplicate_replies[command_name]:
-                    await client.channel.send(
-                                              f'{author.mention} Your message was not sent to prevent multiple replies '
-                                              f'to the same person within 2 seconds.')
-                    return
-                anti_duplicate_replies[command_name] = True
-                if not (command_contents or message.attachments):
-                    await client.channel.send('Did you forget to enter a message?')
-                else:
-                    for server in client.guilds:
-                        member = server.get_member(int(command_name))
-                        if member:
-                            attachments = []
-                            try:
-                                progress_msg = None
-                                if message.attachments:
-                                    size_limit = 0x800000
-                                    size_diff = 0x800
-
-                                    # first check the size of all attachments
-                                    # the 0x800 number is arbitrary, just in case
-                                    # in reality, the file size needs to be like 0x200 smaller than the supposed limit
-                                    error_messages = []
-                                    warning_messages = []
-                                    for a in message.attachments:
-                                        if a.size > size_limit:
-                                            error_messages.append(f'`{disnake.utils.escape_markdown(a.filename)}` '
-                                                                  f'is too large to send in a direct message.')
-                                        elif a.size > size_limit - 0x1000:
-                                            warning_messages.append(f'`{disnake.utils.escape_markdown(a.filename)}` '
-                                                                    f'is very close to the file size limit of the '
-                                                                    f'destination. It may fail to send.')
-
-                                    if error_messages:
-                                        final = '\n'.join(error_messages)
-                                        final += f'\nLimit: {size_limit} bytes ({size_limit / (1024 * 1024):.02f} MiB)'
-                                        final += f'\nRecommended Maximum: {size_limit - size_diff} bytes ' \
-                                                 f'({(size_limit - size_diff) / (1024 * 1024):.02f} MiB)'
-                                        await client.channel.send(final)
-                                        break
-
-                                    if warning_messages:
-                                        final = '\n'.join(warning_messages)
-                                        final += f'\nLimit: {size_limit} bytes ({size_limit / (1024 * 1024):.02f} MiB)'
-                                        final += f'\nRecommended Maximum: {size_limit - size_diff} bytes ' \
-                                                 f'({(size_limit - size_diff) / (1024 * 1024):.02f} MiB)'
-                                        await client.channel.send(final)
-
-                                    count = len(message.attachments)
-                                    progress_msg = await client.channel.send(f'Downloading attachments... 0/{count}')
-                                    for idx, a in enumerate(message.attachments, 1):
-                                        tf = TemporaryFile()
-                                        await a.save(tf, seek_begin=True)
-                                        attachments.append(disnake.File(tf, a.filename))
-                                        await progress_msg.edit(content=f'Downloading attachments... {idx}/{count}')
-
-                                embed = disnake.Embed(color=gen_color(int(command_name)), description=command_contents)
-                                if config['Main'].getboolean('anonymous_staff'):
-                                    to_send = 'Staff reply: '
-                                else:
-                                    to_send = f'{author.mention}: '
-                                to_send += command_contents
-                                try:
-                                    if progress_msg:
-                                        await progress_msg.edit(content=f'Sending message with {len(attachments)} '
-                                                                        f'attachments...')
-                                    staff_msg = await member.send(to_send, files=attachments)
-                                    header_message = f'{author.mention} replying to {member.id} {member.mention}'
-                                    if is_ignored(member.id):
-                                        header_message += ' (replies ignored)'
-
-                                    # add attachment links to mod-mail message
-                                    if staff_msg.attachments:
-                                        attachment_urls = []
-                                        for attachment in staff_msg.attachments:
-                                            attachment_urls.append(f'[{attachment.filename}]({attachment.url}) '
-                                                                   f'({attachment.size} bytes)')
-                                        attachment_msg = '\N{BULLET} ' + '\n\N{BULLET} '.join(attachment_urls)
-                                        embed.add_field(name='Attachments', value=attachment_msg, inline=False)
-
-                                    await client.channel.send(header_message, embed=embed)
-                                    if progress_msg:
-                                        await progress_msg.delete()
-                                    await message.delete()
-
-                                except disnake.errors.Forbidden:
-                                    await client.channel.send(f'{author.mention} {member.mention} has disabled DMs '
-                                                              f'or is not in a shared server.')
-                                break
-                            finally:
-                                for attach in attachments:
-                                    attach.close()
-                    else:
-                        await client.channel.send(f'Failed to find user with ID {command_name}')
-                await asyncio.sleep(2)
-                anti_duplicate_replies[command_name] = False
-
-client.run(config['Main']['token'])
+            handler = commands.get(command_name)
+            if handler:
+                await handler(message, command_name, command_contents)
+            elif command_name.isdigit():
+                await reply_command(message, int(command_name), command_contents)
+            elif ',' in command_name and command_name.replace(',', '').isdigit():
+                user_ids = list(dict.fromkeys(int(x) for x in command_name.split(',') if x))
+                await reply_many(message, user_ids, command_contents)
+
+
+if __name__ == '__main__':
+    # scheduled before the loop starts, so it runs while the client logs in, and on_ready waits for it
+    client.prepared = client.loop.create_task(prepare())
+    client.run(settings.token)
+    database.close()
+    spool.clear()